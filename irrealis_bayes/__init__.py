@@ -3,36 +3,193 @@ Probability mass function (PMF) and cumulative distribution function (CDF)
 classes for use in study of Allen B. Downey's "Think Bayes: Bayesian Statistics
 Made Simple", version 1.0.1.
 '''
-import bisect, random
+import bisect, cmath, math, random
 
 
 def filter_possible_events(pmf):
   return PMF((event, prob) for event, prob in pmf.iteritems() if 0 < prob)
 
 def add_two_independent_pmfs(left_pmf, right_pmf):
-  left_pmf, right_pmf = [filter_possible_events(pmf) for pmf in (left_pmf, right_pmf)]
   result = PMF()
-  for left_event, left_prob in left_pmf.iteritems():
-    for right_event, right_prob in right_pmf.iteritems():
-      sum_event = left_event + right_event
-      result[sum_event] = result.get(sum_event, 0.) + left_prob*right_prob
+  # Sums snap to the operands' lattice. Plain dicts have none; operands with
+  # different lattices can't be combined.
+  lattices = set(getattr(pmf, 'lattice', None) for pmf in (left_pmf, right_pmf)) - set([None])
+  if 1 < len(lattices):
+    raise ValueError("Can't add PMFs quantized to different lattices ({})".format(', '.join(sorted(map(repr, lattices)))))
+  lattice = result.lattice = lattices.pop() if lattices else None
+  left_pmf, right_pmf = [filter_possible_events(pmf) for pmf in (left_pmf, right_pmf)]
+  # Check the lattice once, outside the loop, so unquantized sums pay nothing for it.
+  if lattice:
+    for left_event, left_prob in left_pmf.iteritems():
+      for right_event, right_prob in right_pmf.iteritems():
+        sum_event = lattice(left_event + right_event)
+        result[sum_event] = result.get(sum_event, 0.) + left_prob*right_prob
+  else:
+    for left_event, left_prob in left_pmf.iteritems():
+      for right_event, right_prob in right_pmf.iteritems():
+        sum_event = left_event + right_event
+        result[sum_event] = result.get(sum_event, 0.) + left_prob*right_prob
   return result
 
 def sum_independent_pmfs(pmfs):
   return reduce(lambda x, y: x+y, pmfs)
 
+def log_ratio(numerator, denominator):
+  'Return log(numerator/denominator), or -inf if numerator is zero.'
+  if not numerator: return float('-inf')
+  return math.log(numerator/float(denominator)) if denominator else float('nan')
+
+def log_evidences(suites, data):
+  '''
+  Update each of a list of suites with each datum in turn, returning list of
+  log-evidence, log P(data), each suite accumulated over the data. Suites can
+  be PMFs or anything else that keeps log_evidence up to date in update().
+  '''
+  starts = [suite.log_evidence for suite in suites]
+  for datum in data:
+    for suite in suites:
+      suite.update(datum)
+  return [suite.log_evidence - start for suite, start in zip(suites, starts)]
+
+def bayes_factor(suite_a, suite_b, data):
+  '''
+  Update two suites with data, returning Bayes factor P(data|a)/P(data|b),
+  which is how much the data favor the model of suite_a over that of suite_b.
+  '''
+  log_evidence_a, log_evidence_b = log_evidences((suite_a, suite_b), data)
+  return math.exp(log_evidence_a - log_evidence_b)
+
+
+class Lattice(object):
+  '''
+  Evenly spaced points start + n*step. Calling a lattice with a numeric event
+  returns the nearest lattice point, so events that differ only by rounding
+  error map to the same point.
+  '''
+  def __init__(self, start, step):
+    self.start, self.step = start, step
+
+  def __call__(self, event):
+    return self.start + round((event - self.start)/float(self.step))*self.step
+
+  def __eq__(self, other):
+    return isinstance(other, Lattice) and (self.start, self.step) == (other.start, other.step)
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __hash__(self):
+    return hash((self.start, self.step))
+
+  def __repr__(self):
+    return 'Lattice({!r}, {!r})'.format(self.start, self.step)
+
+
+def fft(values, inverse=False):
+  'Discrete Fourier transform of values, whose length must be a power of two.'
+  n = len(values)
+  values = list(values)
+  # Bit-reversal permutation, then iterative radix-2 butterflies.
+  j = 0
+  for i in xrange(1, n):
+    bit = n >> 1
+    while j & bit:
+      j ^= bit
+      bit >>= 1
+    j |= bit
+    if i < j: values[i], values[j] = values[j], values[i]
+  sign = 1 if inverse else -1
+  length = 2
+  while length <= n:
+    root = cmath.exp(sign*2j*cmath.pi/length)
+    half = length//2
+    twiddles = [root**k for k in xrange(half)]
+    for start in xrange(0, n, length):
+      for k in xrange(half):
+        even, odd = values[start+k], values[start+k+half]*twiddles[k]
+        values[start+k], values[start+k+half] = even + odd, even - odd
+    length *= 2
+  if inverse: values = [value/n for value in values]
+  return values
+
+def convolve(values, kernel):
+  'Full linear convolution of two real sequences, via FFT.'
+  size = len(values) + len(kernel) - 1
+  n = 1
+  while n < size: n *= 2
+  transform = [
+    x*y for x, y in zip(fft(list(values) + [0.]*(n - len(values))), fft(list(kernel) + [0.]*(n - len(kernel))))
+  ]
+  return [value.real for value in fft(transform, inverse=True)[:size]]
+
+def gaussian_kernel(sigma, truncate=4.):
+  'Gaussian weights at integer offsets within truncate*sigma of zero, centered.'
+  half_width = int(math.ceil(truncate*sigma))
+  return [math.exp(-0.5*(offset/float(sigma))**2) for offset in xrange(-half_width, half_width+1)]
+
 
 class PMF(dict):
-  'Dictionary as probability mass function.'
+  '''
+  Dictionary as probability mass function.
+
+  Also keeps log_evidence, the log of the marginal likelihood P(data) of all
+  data passed to update() since the prior was assigned, for model comparison.
+  '''
+  # Lattice to which events are snapped; see quantize().
+  lattice = None
+
   def __init__(self, *al, **kw):
     super(PMF, self).__init__(*al, **kw)
+    self.log_evidence = 0.
 
   def __add__(self, other):
+    # Leave lazy expressions to their __radd__(), which keeps the sum lazy.
+    from irrealis_bayes.lazy import LazyExpression
+    if isinstance(other, LazyExpression): return NotImplemented
     return add_two_independent_pmfs(self, other)
 
+  def lazy(self):
+    'Return lazy expression wrapping this distribution; see irrealis_bayes.lazy.'
+    from irrealis_bayes.lazy import LazyPMF
+    return LazyPMF(self)
+
   def copy(self):
     'Return a shallow copy of this distribution.'
-    return self.__class__(self)
+    pmf = self.__class__(self)
+    pmf.log_evidence = self.log_evidence
+    pmf.lattice = self.lattice
+    return pmf
+
+  def quantize(self, resolution=None, grid=None):
+    '''
+    Snap numeric events to multiples of resolution, or to the lattice of
+    points start + n*step given by grid=(start, step), merging the
+    probabilities of events that snap to the same point. Afterward, events are
+    also snapped when assigned by uniform_dist(), power_law_dist() or incr(),
+    and when combined by adding PMFs, so floating-point rounding can't inflate
+    the number of events. Direct item assignment isn't snapped; use incr() or
+    snap(). Returns self.
+    '''
+    if grid is not None:
+      self.lattice = Lattice(*grid)
+    elif resolution is not None:
+      self.lattice = Lattice(0, resolution)
+    else:
+      raise TypeError('quantize() needs a resolution or a grid')
+    items = self.items()
+    self.clear()
+    for event, prob in items:
+      self.incr(event, prob)
+    return self
+
+  def snap(self, event):
+    "Return event snapped to this distribution's lattice, if it has one."
+    return self.lattice(event) if self.lattice else event
+
+  def incr(self, event, prob=1):
+    'Add prob to the probability of event, after snapping event.'
+    event = self.snap(event)
+    self[event] = self.get(event, 0) + prob
 
   def total(self):
     'Sum elements of this distribution.'
@@ -50,6 +207,14 @@ class PMF(dict):
     except TypeError as e:
       raise TypeError("Can't compute expectation of non-numeric events ({})".format(e))
 
+  def variance(self):
+    'Compute the variance of this distribution.'
+    mean = self.expectation()
+    try:
+      return sum(prob*(event - mean)**2 for event, prob in self.iteritems())
+    except TypeError as e:
+      raise TypeError("Can't compute variance of non-numeric events ({})".format(e))
+
   def scale(self, factor):
     'Scale all measures by a common factor.'
     for key in self:
@@ -77,25 +242,83 @@ class PMF(dict):
       if total >= target:
         return event
 
+  @classmethod
+  def from_samples(cls, samples, grid, bandwidth=None):
+    '''
+    Estimate a distribution over grid, a sequence of evenly spaced events,
+    from a large iterable of numeric samples. Each sample counts toward its
+    nearest grid event; samples beyond the grid are ignored. If bandwidth (a
+    distance in the units of the events) is given, the histogram is smoothed by
+    a Gaussian kernel density estimate, computed by FFT convolution of the
+    binned counts, so the cost is O(samples + grid*log(grid)). Raises
+    ValueError if the grid is empty or not evenly spaced and increasing, if
+    bandwidth isn't positive, or if no sample falls on the grid.
+    '''
+    grid = list(grid)
+    if not grid: raise ValueError("Can't estimate a distribution over an empty grid")
+    if bandwidth is not None and not 0 < bandwidth:
+      raise ValueError('bandwidth must be positive, not {}'.format(bandwidth))
+    start, step = grid[0], float(grid[1] - grid[0]) if 1 < len(grid) else 1.
+    # Allow for rounding error in float grids.
+    if not 0 < step or any(1e-6*step < abs(event - (start + n*step)) for n, event in enumerate(grid)):
+      raise ValueError('Grid must be evenly spaced and increasing')
+    counts = [0.]*len(grid)
+    for sample in samples:
+      index = int(round((sample - start)/step))
+      if 0 <= index < len(counts): counts[index] += 1
+    if not any(counts): raise ValueError('No samples fall on the grid')
+    if bandwidth is not None:
+      kernel = gaussian_kernel(bandwidth/step)
+      half_width = len(kernel)//2
+      counts = convolve(counts, kernel)[half_width:half_width+len(grid)]
+      # Rounding error in the transform can leave tiny negative values.
+      counts = [max(count, 0.) for count in counts]
+    pmf = cls(zip(grid, counts))
+    pmf.normalize()
+    return pmf
+
   def uniform_dist(self, events):
     'Assign equal probabilities to each of a list of events.'
     self.clear()
+    self.log_evidence = 0.
     for event in events:
-      self[event] = 1
+      self[self.snap(event)] = 1
     self.normalize()
 
   def power_law_dist(self, events, alpha=1.):
     'Assign power law distribution to each of a list of quantitative events.'
     self.clear()
+    self.log_evidence = 0.
     for event in events:
+      event = self.snap(event)
       self[event] = event**(-alpha)
     self.normalize()
 
   def update(self, data):
     'Updates posterior probability distribution given new data.'
-    for event in self:
-      self[event] *= self.likelihood(data, given = event)
-    self.normalize()
+    prior_total = self.total()
+    events = self.keys()
+    for event, likelihood in zip(events, self.likelihoods(data, events)):
+      self[event] *= likelihood
+    # The normalizing total is the evidence, P(data).
+    total = self.total()
+    self.log_evidence += log_ratio(total, prior_total)
+    self.scale(1./total if total else float('inf'))
+
+  def predictive(self, outcomes):
+    '''
+    Returns posterior predictive distribution over outcomes, the possible
+    values of the next observation: each outcome's probability is the sum over
+    events of the event's probability times the likelihood of the outcome
+    given the event. Normalized over the outcomes given.
+    '''
+    events = [event for event, prob in self.iteritems() if prob]
+    probs = [self[event] for event in events]
+    result = PMF()
+    for outcome in outcomes:
+      result[outcome] = sum(prob*likelihood for prob, likelihood in zip(probs, self.likelihoods(outcome, events)))
+    result.normalize()
+    return result
 
   def likelihood(self, data, given):
     '''
@@ -104,6 +327,105 @@ class PMF(dict):
     '''
     raise NotImplementedError
 
+  def likelihoods(self, data, events):
+    '''
+    Returns list of likelihoods of observed data given each of a list of
+    events. Calls likelihood() per event; subclasses can override this to
+    compute all of them in one pass.
+    '''
+    return [self.likelihood(data, given = event) for event in events]
+
+
+
+class AdaptiveGridPMF(PMF):
+  '''
+  PMF over a grid of continuous hypotheses that is refined where it matters.
+
+  Each event is the center of a cell of the hypothesis range, with mass
+  proportional to prior(event)*width. Start with a coarse grid_dist(), update()
+  as usual, then refine(): cells holding significant posterior mass are split,
+  and the new points are weighted by re-evaluating the prior and every
+  observation seen so far; cells of negligible mass are dropped. This gives
+  fine resolution near the posterior mode without paying for it everywhere.
+
+  Subclasses implement likelihood() as for PMF, and may override prior(),
+  which defaults to uniform.
+  '''
+  def __init__(self, *al, **kw):
+    super(AdaptiveGridPMF, self).__init__(*al, **kw)
+    self.widths = {}
+    self.observations = []
+
+  def copy(self):
+    'Return a shallow copy of this distribution, including its cells and observations.'
+    pmf = super(AdaptiveGridPMF, self).copy()
+    pmf.widths = dict(self.widths)
+    pmf.observations = list(self.observations)
+    return pmf
+
+  def prior(self, event):
+    'Returns prior density at event. Uniform unless overridden.'
+    return 1.
+
+  def grid_dist(self, low, high, cells):
+    'Assign prior to evenly spaced cells partitioning the range [low, high].'
+    self.clear()
+    self.widths.clear()
+    del self.observations[:]
+    self.log_evidence = 0.
+    width = float(high - low)/cells
+    for n in xrange(cells):
+      event = low + (n + 0.5)*width
+      self.widths[event] = width
+      self[event] = self.prior(event)*width
+    self.normalize()
+
+  def update(self, data):
+    'Updates posterior probability distribution given new data.'
+    super(AdaptiveGridPMF, self).update(data)
+    # Only record data that updated successfully, since refine() replays it.
+    self.observations.append(data)
+
+  def split(self, event, factor):
+    '''
+    Replace event's cell by factor equal subcells. Subcell masses are scaled
+    relative to the parent's mass by ratios of prior and likelihoods, so they
+    are consistent with the rest of the distribution without renormalizing.
+    '''
+    mass, width = self.pop(event), self.widths.pop(event)
+    sub_width = width/factor
+    sub_events = [event - width/2. + (n + 0.5)*sub_width for n in xrange(factor)]
+    parent_weight = self.prior(event)*width
+    ratios = [self.prior(sub_event)*sub_width/parent_weight for sub_event in sub_events]
+    for data in self.observations:
+      if not any(ratios): break
+      likelihoods = self.likelihoods(data, [event] + sub_events)
+      ratios = [ratio*likelihood/likelihoods[0] for ratio, likelihood in zip(ratios, likelihoods[1:])]
+    for sub_event, ratio in zip(sub_events, ratios):
+      self.widths[sub_event] = sub_width
+      self[sub_event] = mass*ratio
+
+  def refine(self, significant=0.01, negligible=1e-9, factor=2, min_width=0.):
+    '''
+    Split cells with posterior mass of at least significant into factor
+    subcells, unless that would make them narrower than min_width, and drop
+    cells with mass below negligible. Returns number of cells split. Raises
+    ValueError if events were assigned other than by grid_dist() or refine(),
+    for example by uniform_dist(), so they have no cells.
+    '''
+    if len(self.widths) != len(self) or any(event not in self.widths for event in self):
+      raise ValueError("Can't refine events without cells; assign the prior with grid_dist()")
+    for event in [event for event, prob in self.iteritems() if prob < negligible]:
+      del self[event]
+      del self.widths[event]
+    splits = [
+      event for event, prob in self.iteritems()
+      if significant <= prob and min_width <= self.widths[event]/factor
+    ]
+    for event in splits: self.split(event, factor)
+    self.normalize()
+    return len(splits)
+
 
 def dict_items_from_data(data):
   'Convert data into a dict, then return its elements as key-value pairs.'
@@ -154,3 +476,123 @@ class CDF(object):
     credible_interval = cdf.percentiles(0.05, 0.95)
     '''
     return tuple(self.percentile(probability) for probability in probabilities)
+
+
+class DynamicCDF(object):
+  '''
+  Discrete cumulative distribution function supporting changes.
+
+  Where CDF is an immutable snapshot that must be rebuilt to change any
+  event's probability, DynamicCDF keeps event weights in a binary indexed
+  (Fenwick) tree over the sorted events, so set(), add(), prob(),
+  cumulative(), percentile() and random() each take O(log n). Weights needn't
+  be normalized. Adding an event not seen at construction rebuilds the tree in
+  O(n log n).
+
+  Tree nodes accumulate changes, so after weights shrink by many orders of
+  magnitude the nodes carry rounding error from their old values; call
+  refresh() to resum them.
+  '''
+  def __init__(self, data=None, cmp=None, key=None, reverse=False):
+    self.sort_args = (cmp, key, reverse)
+    self.rebuild(dict_items_from_data(data))
+
+  def rebuild(self, items):
+    'Replace contents with given (event, weight) pairs.'
+    items = list(items)
+    sort_items(items, *self.sort_args)
+    self.events = tuple(event for event, weight in items)
+    self.index = dict((event, index) for index, event in enumerate(self.events))
+    self.weights = [weight for event, weight in items]
+    # tree[i] holds the sum of weights[i-(i&-i):i], with one-based i.
+    self.tree = [0.]*(len(self.weights)+1)
+    for i, weight in enumerate(self.weights, 1):
+      self.tree[i] += weight
+      parent = i + (i & -i)
+      if parent < len(self.tree): self.tree[parent] += self.tree[i]
+
+  def refresh(self):
+    'Resum tree from current weights, discarding accumulated rounding error.'
+    self.rebuild(zip(self.events, self.weights))
+
+  def __len__(self):
+    return len(self.events)
+
+  def total(self):
+    'Sum weights of all events.'
+    return self.prefix_sum(len(self.weights))
+
+  def prefix_sum(self, count):
+    'Sum weights of the first count events.'
+    total = 0.
+    while count:
+      total += self.tree[count]
+      count -= count & -count
+    return total
+
+  def add(self, event, delta):
+    "Add delta to event's weight."
+    if event not in self.index:
+      return self.rebuild(zip(self.events, self.weights) + [(event, delta)])
+    index = self.index[event]
+    self.weights[index] += delta
+    i = index+1
+    while i < len(self.tree):
+      self.tree[i] += delta
+      i += i & -i
+
+  def set(self, event, weight):
+    "Set event's weight."
+    self.add(event, weight - self.weights[self.index[event]] if event in self.index else weight)
+
+  def weight(self, event):
+    "Return event's unnormalized weight."
+    return self.weights[self.index[event]]
+
+  def prob(self, event):
+    "Return event's probability."
+    return self.weight(event)/self.total()
+
+  def cumulative(self, event):
+    'Return probability of given or any earlier event.'
+    return self.prefix_sum(self.index[event]+1)/self.total()
+
+  def search(self, target, strict=False):
+    '''
+    Get index of first event at which the running sum of weights reaches
+    target (or, if strict, exceeds it).
+    '''
+    index, mask = 0, 1
+    while mask*2 < len(self.tree): mask *= 2
+    while mask:
+      next_index = index + mask
+      if next_index < len(self.tree) and (self.tree[next_index] <= target if strict else self.tree[next_index] < target):
+        index = next_index
+        target -= self.tree[next_index]
+      mask //= 2
+    return min(index, len(self.events)-1)
+
+  def floor_index(self, probability):
+    'Get index of last event at or below given percentile (specified as probability).'
+    return self.search(probability*self.total())
+
+  def percentile(self, probability):
+    'Return event corresponding to percentile (specified as probability).'
+    return self.events[self.floor_index(probability)]
+
+  def percentiles(self, *probabilities):
+    'Return list of event corresponding list of percentiles (specified as probabilities).'
+    return tuple(self.percentile(probability) for probability in probabilities)
+
+  def random(self):
+    '''
+    Returns random event.
+    Probability of returning this event is determined by this distribution.
+    '''
+    return self.events[self.search(random.random()*self.total(), strict=True)]
+
+  def to_pmf(self, cls=PMF):
+    'Return weights as a normalized PMF.'
+    pmf = cls(zip(self.events, self.weights))
+    pmf.normalize()
+    return pmf
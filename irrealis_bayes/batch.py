@@ -0,0 +1,112 @@
+'''
+Many independent posteriors over one shared hypothesis grid.
+
+When thousands of posteriors share the same events, for example per-customer
+euro-style rate estimates over xrange(101), keeping each as its own PMF pays
+for a likelihood() call per event per posterior on every update. A
+BatchedPosterior stores them as rows of one matrix (posteriors by events) and
+applies a batch of per-posterior observations at once: the likelihood vector
+of each distinct observation is computed once and then multiplied into every
+row that observed it, followed by row-wise normalization. Summaries such as
+expectation() and percentiles() are computed for every row in one call.
+'''
+from irrealis_bayes import PMF, log_ratio, sort_items
+
+
+class BatchedPosterior(object):
+  '''
+  Matrix of posteriors over shared events. Subclasses implement likelihood(),
+  or likelihoods() to compute a whole likelihood vector in one pass, exactly
+  as for PMF.
+  '''
+  def __init__(self, events, posteriors, prior=None):
+    '''
+    Create posteriors copies of prior, a PMF or dict over events (uniform by
+    default).
+    '''
+    items = [(event, prior[event] if prior else 1.) for event in events]
+    sort_items(items)
+    self.events = [event for event, weight in items]
+    total = float(sum(weight for event, weight in items))
+    prior_row = [weight/total for event, weight in items]
+    self.rows = [list(prior_row) for n in xrange(posteriors)]
+    self.log_evidence = [0.]*posteriors
+
+  def __len__(self):
+    return len(self.rows)
+
+  def likelihood(self, data, given):
+    '''
+    Returns likelihood of observed data given a event. Unimplemented.
+    Should be implemented in subclasses.
+    '''
+    raise NotImplementedError
+
+  def likelihoods(self, data, events):
+    '''
+    Returns list of likelihoods of observed data given each of a list of
+    events. Calls likelihood() per event; subclasses can override this to
+    compute all of them in one pass.
+    '''
+    return [self.likelihood(data, given = event) for event in events]
+
+  def update(self, observations):
+    '''
+    Updates posteriors given one datum per posterior, in row order. A datum of
+    None leaves its posterior unchanged. Raises ValueError unless there is
+    exactly one datum per posterior.
+    '''
+    observations = list(observations)
+    if len(observations) != len(self.rows):
+      raise ValueError('Expected {} observations, one per posterior, not {}'.format(len(self.rows), len(observations)))
+    vectors = {}
+    for index, (row, data) in enumerate(zip(self.rows, observations)):
+      if data is None: continue
+      try:
+        vector = vectors[data]
+      except KeyError:
+        vector = vectors[data] = self.likelihoods(data, self.events)
+      except TypeError:
+        # Unhashable data can't share vectors.
+        vector = self.likelihoods(data, self.events)
+      prior_total = sum(row)
+      row[:] = [weight*likelihood for weight, likelihood in zip(row, vector)]
+      total = sum(row)
+      self.log_evidence[index] += log_ratio(total, prior_total)
+      normalizer = 1./total if total else float('inf')
+      row[:] = [weight*normalizer for weight in row]
+
+  def update_each(self, data):
+    'Updates every posterior given the same datum.'
+    self.update([data]*len(self.rows))
+
+  def expectation(self):
+    'Compute list of expectations, aka means, of the posteriors.'
+    return [
+      sum(event*weight for event, weight in zip(self.events, row))
+      for row in self.rows
+    ]
+
+  def percentiles(self, *probabilities):
+    '''
+    Return list, with a tuple per posterior, of events corresponding to list
+    of percentiles (specified as probabilities), as with CDF.percentiles().
+    '''
+    order = sorted(xrange(len(probabilities)), key=lambda n: probabilities[n])
+    results = []
+    for row in self.rows:
+      found = [None]*len(probabilities)
+      index, total = 0, row[0]
+      for n in order:
+        while total < probabilities[n] and index < len(row)-1:
+          index += 1
+          total += row[index]
+        found[n] = self.events[index]
+      results.append(tuple(found))
+    return results
+
+  def pmf(self, index, cls=PMF):
+    'Return posterior of given row as a PMF.'
+    pmf = cls(zip(self.events, self.rows[index]))
+    pmf.log_evidence = self.log_evidence[index]
+    return pmf
@@ -0,0 +1,101 @@
+'''
+Monte Carlo calibration of PMF models.
+
+A single simulated experiment (as in the German tank test) says little about
+whether a model's credible intervals can be trusted. calibrate() runs many
+independent experiments: each draws a true parameter, draws observations given
+that parameter, updates a copy of the prior, and checks whether the credible
+interval covers the true parameter. If the model is calibrated, a 90% interval
+should cover about 90% of the time.
+
+Trials run across a process pool. Each trial seeds the random number generator
+from the base seed and its own trial number, and results are combined in trial
+order, so reports are reproducible and don't depend on the number of workers.
+'''
+import multiprocessing, random
+
+from irrealis_bayes import CDF
+
+
+class CalibrationReport(object):
+  'Summary of a calibration run.'
+  def __init__(self, interval, covered, errors):
+    self.interval = interval
+    self.trials = len(covered)
+    # Fraction of trials whose credible interval covered the true parameter.
+    self.coverage = float(sum(covered))/self.trials
+    # Mean of expectation() minus true parameter.
+    self.bias = sum(errors)/self.trials
+    # Root mean square of expectation() minus true parameter.
+    self.rmse = (sum(error*error for error in errors)/self.trials)**0.5
+
+  def __repr__(self):
+    return 'CalibrationReport(interval={}, trials={}, coverage={}, bias={}, rmse={})'.format(
+      self.interval, self.trials, self.coverage, self.bias, self.rmse
+    )
+
+
+def trial_seed(seed, trial):
+  'Seed for given trial, independent of which worker runs it.'
+  return seed*2**32 + trial
+
+def run_trial(experiment, seed):
+  '''
+  Run one simulated experiment, returning whether the credible interval
+  covered the true parameter, and the error of the posterior expectation.
+  '''
+  suite, sample_parameter, sample_observation, observations, interval = experiment
+  random.seed(seed)
+  parameter = sample_parameter()
+  pmf = suite.copy()
+  pmf.normalize()
+  for n in xrange(observations):
+    pmf.update(sample_observation(parameter))
+  low, high = CDF(pmf).percentiles(*interval)
+  return low <= parameter <= high, pmf.expectation() - parameter
+
+# Experiment shared by trials run in a worker process; see calibrate().
+worker_experiment = None
+
+def set_worker_experiment(experiment):
+  global worker_experiment
+  worker_experiment = experiment
+
+def run_worker_trial(seed):
+  return run_trial(worker_experiment, seed)
+
+def calibrate(suite, sample_parameter, sample_observation, observations,
+  trials=1000, interval=(0.05, 0.95), processes=None, seed=0):
+  '''
+  Check calibration of a model by simulation.
+
+  suite is the prior, a PMF subclass instance implementing likelihood(). Each
+  trial draws a true parameter with sample_parameter(), then draws the given
+  number of observations with sample_observation(parameter), updating a copy
+  of suite with each. Both samplers should use the random module.
+
+  Runs trials over processes workers (default: one per CPU); with
+  processes=1, runs them in this process instead. When running in a pool,
+  suite's class and both samplers must be picklable, so define them at module
+  level.
+
+  Returns CalibrationReport of interval coverage and expectation error.
+  '''
+  experiment = (suite, sample_parameter, sample_observation, observations, interval)
+  seeds = [trial_seed(seed, trial) for trial in xrange(trials)]
+  if processes == 1:
+    state = random.getstate()
+    try:
+      results = [run_trial(experiment, each_seed) for each_seed in seeds]
+    finally:
+      random.setstate(state)
+  else:
+    pool = multiprocessing.Pool(processes, set_worker_experiment, (experiment,))
+    try:
+      # map() returns results in trial order, whichever worker ran them.
+      results = pool.map(run_worker_trial, seeds, chunksize=max(1, trials//(4*(processes or multiprocessing.cpu_count()))))
+    finally:
+      pool.close()
+      pool.join()
+  covered, errors = zip(*results)
+  return CalibrationReport(interval, covered, errors)
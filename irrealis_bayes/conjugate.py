@@ -0,0 +1,307 @@
+'''
+Closed-form conjugate posteriors.
+
+When the prior is conjugate to the likelihood, the posterior stays in the
+prior's family and each observation just adjusts its parameters, so an update
+costs O(1) rather than a pass over a grid of hypotheses. The euro problem, for
+example, is Beta-Binomial: 250 grid updates give the same answer as adding 140
+and 110 to the parameters of a uniform Beta prior.
+
+These classes mirror the PMF and CDF methods that inference code uses:
+update(), expectation(), random(), percentile() and percentiles(). Use
+to_pmf(grid) to get a grid PMF for code that needs one. Like PMF, they keep
+log_evidence, the log marginal likelihood of the data seen so far.
+'''
+import math, random
+
+from irrealis_bayes import PMF
+
+
+def log_beta(a, b):
+  'Log of the beta function B(a, b).'
+  return math.lgamma(a) + math.lgamma(b) - math.lgamma(a + b)
+
+def beta_continued_fraction(x, a, b, max_iterations=300, epsilon=3e-16):
+  'Continued fraction for the incomplete beta function, by the modified Lentz method.'
+  tiny = 1e-300
+  c, d = 1., 1. - (a + b)*x/(a + 1.)
+  d = 1./(d if abs(d) > tiny else tiny)
+  result = d
+  for m in xrange(1, max_iterations):
+    for numerator in (
+      m*(b - m)*x/((a + 2*m - 1.)*(a + 2*m)),
+      -(a + m)*(a + b + m)*x/((a + 2*m)*(a + 2*m + 1.)),
+    ):
+      d = 1. + numerator*d
+      d = 1./(d if abs(d) > tiny else tiny)
+      c = 1. + numerator/c
+      if abs(c) < tiny: c = tiny
+      delta = c*d
+      result *= delta
+    if abs(delta - 1.) < epsilon: break
+  return result
+
+def regularized_beta(x, a, b):
+  'Regularized incomplete beta function I_x(a, b), the Beta(a, b) CDF at x.'
+  if x <= 0.: return 0.
+  if 1. <= x: return 1.
+  # The continued fraction converges fast below the mean; use symmetry above.
+  if (a + 1.)/(a + b + 2.) < x:
+    return 1. - regularized_beta(1. - x, b, a)
+  front = math.exp(a*math.log(x) + b*math.log(1. - x) - log_beta(a, b))
+  return front*beta_continued_fraction(x, a, b)/a
+
+def regularized_gamma(x, a):
+  'Regularized lower incomplete gamma function P(a, x), the Gamma(a, 1) CDF at x.'
+  if x <= 0.: return 0.
+  log_front = a*math.log(x) - x - math.lgamma(a)
+  if x < a + 1.:
+    # Series expansion.
+    term = total = 1./a
+    n = a
+    while abs(term) > abs(total)*3e-16:
+      n += 1.
+      term *= x/n
+      total += term
+    return total*math.exp(log_front)
+  # Continued fraction for the upper tail Q(a, x), again by modified Lentz.
+  tiny = 1e-300
+  b = x + 1. - a
+  c, d = 1./tiny, 1./b
+  h = d
+  for i in xrange(1, 1000):
+    an = -i*(i - a)
+    b += 2.
+    d = an*d + b
+    d = 1./(d if abs(d) > tiny else tiny)
+    c = b + an/c
+    if abs(c) < tiny: c = tiny
+    delta = d*c
+    h *= delta
+    if abs(delta - 1.) < 3e-16: break
+  return 1. - math.exp(log_front)*h
+
+def inverse_cdf(cdf, probability, low, high, tolerance=1e-12):
+  'Find x in [low, high] with cdf(x) == probability by bisection.'
+  while tolerance < high - low:
+    middle = (low + high)/2.
+    if cdf(middle) < probability:
+      low = middle
+    else:
+      high = middle
+  return (low + high)/2.
+
+
+class ConjugatePosterior(object):
+  '''
+  Base class for closed-form posteriors over a continuous parameter.
+  Subclasses implement cdf(), density(), expectation(), random() and update().
+  '''
+  def update(self, data):
+    'Updates posterior given new data. Unimplemented.'
+    raise NotImplementedError
+
+  def percentile(self, probability):
+    'Return parameter value corresponding to percentile (specified as probability).'
+    raise NotImplementedError
+
+  def percentiles(self, *probabilities):
+    '''
+    Return list of parameter values corresponding to list of percentiles
+    (specified as probabilities), as with CDF.percentiles().
+    '''
+    return tuple(self.percentile(probability) for probability in probabilities)
+
+  def sample(self, n):
+    'Return list of n random draws of the parameter.'
+    return [self.random() for i in xrange(n)]
+
+  def to_pmf(self, grid, scale=1., cls=PMF):
+    '''
+    Return normalized PMF over grid events, weighted by posterior density at
+    event/scale. For the euro problem's percent hypotheses, use
+    to_pmf(xrange(101), scale=100.).
+    '''
+    pmf = cls((event, self.density(event/float(scale))) for event in grid)
+    pmf.normalize()
+    return pmf
+
+
+class BetaBinomial(ConjugatePosterior):
+  '''
+  Beta posterior on a success probability, given Bernoulli observations.
+  update(data) counts data == success as a success, anything else as failure.
+  '''
+  def __init__(self, alpha=1., beta=1., success=True):
+    self.alpha, self.beta, self.success = float(alpha), float(beta), success
+    self.log_evidence = 0.
+
+  def update(self, data):
+    'Updates posterior given one observation.'
+    if data == self.success:
+      self.observe(1, 0)
+    else:
+      self.observe(0, 1)
+
+  def observe(self, successes, failures):
+    'Updates posterior given counts of successes and failures.'
+    # Evidence of any one sequence with these counts.
+    self.log_evidence += log_beta(self.alpha + successes, self.beta + failures) - log_beta(self.alpha, self.beta)
+    self.alpha += successes
+    self.beta += failures
+
+  def expectation(self):
+    'Compute the expectation, aka mean, of the success probability.'
+    return self.alpha/(self.alpha + self.beta)
+
+  def density(self, x):
+    'Beta probability density at x.'
+    if not 0. < x < 1.:
+      if x not in (0., 1.): return 0.
+      # At an endpoint, density is zero, finite or infinite according to the
+      # exponent of that endpoint's factor.
+      exponent = self.alpha - 1 if x == 0. else self.beta - 1
+      if exponent: return 0. if 0 < exponent else float('inf')
+      return math.exp(-log_beta(self.alpha, self.beta))
+    return math.exp((self.alpha - 1)*math.log(x) + (self.beta - 1)*math.log(1. - x) - log_beta(self.alpha, self.beta))
+
+  def cdf(self, x):
+    'Return probability that the success probability is at most x.'
+    return regularized_beta(x, self.alpha, self.beta)
+
+  def percentile(self, probability):
+    'Return success probability corresponding to percentile (specified as probability).'
+    return inverse_cdf(self.cdf, probability, 0., 1.)
+
+  def random(self):
+    'Return random draw of the success probability.'
+    return random.betavariate(self.alpha, self.beta)
+
+
+class GammaPoisson(ConjugatePosterior):
+  '''
+  Gamma posterior on a Poisson rate, given counts observed over exposures.
+  update(count) counts events seen in one unit of exposure. The default prior
+  is flat and improper until something has been observed; until then,
+  queries raise ValueError.
+  '''
+  def __init__(self, shape=1., rate=0.):
+    self.shape, self.rate = float(shape), float(rate)
+    self.log_evidence = 0.
+
+  def update(self, data):
+    'Updates posterior given count of events in one unit of exposure.'
+    self.observe(data, 1)
+
+  def observe(self, count, exposure):
+    '''
+    Updates posterior given total count of events over given exposure. The
+    evidence is that of the total count, which is negative binomial; under an
+    improper prior it is undefined (nan).
+    '''
+    if self.rate:
+      self.log_evidence += (
+        math.lgamma(self.shape + count) - math.lgamma(self.shape) - math.lgamma(count + 1.)
+        + self.shape*math.log(self.rate/(self.rate + exposure))
+        + count*math.log(exposure/(self.rate + exposure))
+      )
+    else:
+      self.log_evidence = float('nan')
+    self.shape += count
+    self.rate += exposure
+
+  def check_proper(self):
+    'Raise ValueError unless the posterior is a proper distribution.'
+    if not (0 < self.shape and 0 < self.rate):
+      raise ValueError(
+        'Gamma posterior is improper (shape={}, rate={}); observe some exposure or use a proper prior'.format(self.shape, self.rate)
+      )
+
+  def expectation(self):
+    'Compute the expectation, aka mean, of the rate.'
+    self.check_proper()
+    return self.shape/self.rate
+
+  def density(self, x):
+    'Gamma probability density at x.'
+    self.check_proper()
+    if x <= 0.: return 0.
+    return math.exp(self.shape*math.log(self.rate) + (self.shape - 1)*math.log(x) - self.rate*x - math.lgamma(self.shape))
+
+  def cdf(self, x):
+    'Return probability that the rate is at most x.'
+    self.check_proper()
+    return regularized_gamma(self.rate*x, self.shape)
+
+  def percentile(self, probability):
+    'Return rate corresponding to percentile (specified as probability).'
+    high = self.expectation() or 1.
+    while self.cdf(high) < probability: high *= 2
+    return inverse_cdf(self.cdf, probability, 0., high, tolerance=high*1e-12)
+
+  def random(self):
+    'Return random draw of the rate.'
+    self.check_proper()
+    return random.gammavariate(self.shape, 1./self.rate)
+
+
+class DirichletMultinomial(object):
+  '''
+  Dirichlet posterior on the probabilities of categories, given categorical
+  observations. Construct with a dict (or PMF) of prior pseudo-counts.
+  '''
+  def __init__(self, alphas):
+    self.alphas = dict((category, float(alpha)) for category, alpha in dict(alphas).iteritems())
+    self.log_evidence = 0.
+
+  def update(self, data):
+    'Updates posterior given one observed category.'
+    self.observe({data: 1})
+
+  def observe(self, counts):
+    'Updates posterior given dict of category counts.'
+    counts = [(category, self.alphas[category], count) for category, count in dict(counts).iteritems()]
+    # Evidence of any one sequence with these counts.
+    total = self.total()
+    self.log_evidence += math.lgamma(total) - math.lgamma(total + sum(count for category, alpha, count in counts))
+    for category, alpha, count in counts:
+      self.log_evidence += math.lgamma(alpha + count) - math.lgamma(alpha)
+      self.alphas[category] = alpha + count
+
+  def total(self):
+    return sum(self.alphas.itervalues())
+
+  def marginal(self, category):
+    "Return BetaBinomial posterior of one category's probability."
+    alpha = self.alphas[category]
+    return BetaBinomial(alpha, self.total() - alpha, category)
+
+  def expectation(self):
+    'Return PMF of the mean probability of each category.'
+    return self.to_pmf()
+
+  def percentiles(self, *probabilities):
+    "Return dict of percentiles of each category's probability."
+    return dict(
+      (category, self.marginal(category).percentiles(*probabilities))
+      for category in self.alphas
+    )
+
+  def random(self):
+    'Return PMF of randomly drawn category probabilities.'
+    pmf = PMF((category, random.gammavariate(alpha, 1.)) for category, alpha in self.alphas.iteritems())
+    pmf.normalize()
+    return pmf
+
+  def sample(self, n):
+    'Return list of n random draws of category probabilities.'
+    return [self.random() for i in xrange(n)]
+
+  def to_pmf(self, cls=PMF):
+    '''
+    Return normalized PMF of mean category probabilities, which is also the
+    predictive distribution of the next category.
+    '''
+    pmf = cls(self.alphas)
+    pmf.normalize()
+    return pmf
@@ -0,0 +1,139 @@
+'''
+Lazy arithmetic on PMFs.
+
+Adding PMFs convolves them, which costs the product of their support sizes,
+even when all the caller wants is the mean. In lazy mode, + builds an
+expression instead. Means and variances of sums of independent distributions
+are the sums of the operands' means and variances, so expectation() and
+variance() are answered from the operands without convolving. The full
+distribution is built only when needed, for percentiles, sampling or point
+probabilities, and then the operands are convolved smallest first, which keeps
+intermediate supports small.
+
+Enter lazy mode with pmf.lazy(); dicts added to an expression are treated as
+PMFs, and plain numbers shift it. sum_independent_pmfs() of lazy operands is
+lazy too:
+
+  total = sum_independent_pmfs([pmf.lazy() for pmf in pmfs])
+  total.expectation()          # no convolution
+  total.percentiles(0.05, 0.95) # convolves once, then caches
+
+Operands that don't sum to one are normalized, in a copy, when wrapped, so
+moments and evaluated distributions are those of probability distributions.
+Otherwise expressions read their operands when evaluated and cache the result,
+so don't change operands after building an expression from them.
+'''
+import heapq
+
+from irrealis_bayes import CDF, PMF, add_two_independent_pmfs
+
+
+def as_lazy(operand):
+  'Wrap PMF, dict or number as a lazy expression; pass expressions through.'
+  if isinstance(operand, LazyExpression): return operand
+  if isinstance(operand, PMF): return LazyPMF(operand)
+  if isinstance(operand, dict): return LazyPMF(PMF(operand))
+  return LazyPMF(PMF({operand: 1.}))
+
+def add_smallest_first(pmfs):
+  '''
+  Sum independent PMFs, always adding the two with fewest events next, which
+  keeps intermediate convolutions cheap.
+  '''
+  heap = [(len(pmf), n, pmf) for n, pmf in enumerate(pmfs)]
+  heapq.heapify(heap)
+  count = len(heap)
+  while 1 < len(heap):
+    left, right = heapq.heappop(heap)[2], heapq.heappop(heap)[2]
+    total = add_two_independent_pmfs(left, right)
+    heapq.heappush(heap, (len(total), count, total))
+    count += 1
+  return heap[0][2]
+
+
+class LazyExpression(object):
+  'Base class of lazy PMF expressions.'
+  def __add__(self, other):
+    return LazySum(self.terms() + as_lazy(other).terms())
+
+  def __radd__(self, other):
+    return LazySum(as_lazy(other).terms() + self.terms())
+
+  def terms(self):
+    'Return list of independent expressions summed by this one.'
+    return [self]
+
+  def evaluate(self):
+    'Return PMF of this expression. Unimplemented.'
+    raise NotImplementedError
+
+  def __getitem__(self, event):
+    return self.evaluate()[event]
+
+  def get(self, event, default=None):
+    return self.evaluate().get(event, default)
+
+  def iteritems(self):
+    return self.evaluate().iteritems()
+
+  def __len__(self):
+    return len(self.evaluate())
+
+  def cdf(self):
+    'Return CDF of this expression.'
+    return CDF(self.evaluate())
+
+  def percentile(self, probability):
+    'Return event corresponding to percentile (specified as probability).'
+    return self.cdf().percentile(probability)
+
+  def percentiles(self, *probabilities):
+    'Return list of events corresponding to list of percentiles (specified as probabilities).'
+    return self.cdf().percentiles(*probabilities)
+
+  def random(self):
+    'Returns random event.'
+    return self.evaluate().random()
+
+
+class LazyPMF(LazyExpression):
+  'Lazy expression for a PMF, normalized if it sums to anything but one.'
+  def __init__(self, pmf):
+    if pmf.total() != 1.:
+      pmf = pmf.copy()
+      pmf.normalize()
+    self.pmf = pmf
+
+  def evaluate(self):
+    return self.pmf
+
+  def expectation(self):
+    'Compute the expectation, aka mean, of this distribution.'
+    return self.pmf.expectation()
+
+  def variance(self):
+    'Compute the variance of this distribution.'
+    return self.pmf.variance()
+
+
+class LazySum(LazyExpression):
+  'Lazy expression for the sum of independent expressions.'
+  def __init__(self, terms):
+    self._terms = terms
+    self._value = None
+
+  def terms(self):
+    return list(self._terms)
+
+  def evaluate(self):
+    if self._value is None:
+      self._value = add_smallest_first([term.evaluate() for term in self._terms])
+    return self._value
+
+  def expectation(self):
+    "Compute the expectation, aka mean, as the sum of the terms' expectations."
+    return sum(term.expectation() for term in self._terms)
+
+  def variance(self):
+    "Compute the variance as the sum of the independent terms' variances."
+    return sum(term.variance() for term in self._terms)
@@ -0,0 +1,261 @@
+'''
+Local HTTP/JSON inference server holding named posteriors in memory, so that
+many client processes can share one warm model instead of each rebuilding its
+own priors.
+
+Posteriors are ordinary PMF subclasses. To serve them from the command line,
+name a factory for each one:
+
+  python -m irrealis_bayes.server --port 8000 euro=mymodels:make_euro_pmf
+
+Endpoints (all responses are JSON):
+
+  GET  /posteriors                          names of hosted posteriors
+  GET  /posteriors/<name>/expectation       {"expectation": ...}
+  GET  /posteriors/<name>/percentiles?p=0.05&p=0.95
+                                            {"percentiles": [...]}
+  GET  /posteriors/<name>/sample?n=10       {"sample": [...]}
+  POST /posteriors/<name>/update            body {"observations": [...]}
+                                            {"updates": <count applied>}
+                                            or 400 {"error": ...}
+
+Each request is handled on its own thread, so a long update never stalls the
+accept loop. Updates are coalesced per posterior: observations are queued, and
+whichever thread holds the posterior's update lock applies everything queued so
+far in one pass, to a copy of the posterior, and publishes the copy. If the
+batch fails, its submissions are retried one at a time, so only a client whose
+own observations fail (or are impossible under every hypothesis) gets a 400
+response, and its observations leave the posterior unchanged. Queries never
+wait on updates; they read the most recently published posterior.
+'''
+import BaseHTTPServer, SocketServer
+import json, threading, urlparse
+
+from irrealis_bayes import CDF
+
+
+class UpdateError(ValueError):
+  'Raised when a batch of observations could not be applied.'
+
+
+class NotFound(Exception):
+  'Raised when a request names no endpoint or posterior; answered with 404.'
+
+
+class Submission(object):
+  "One client's observations, and the outcome of the batch they joined."
+  def __init__(self, observations):
+    self.observations = observations
+    self.done = False
+    self.error = None
+
+
+class HostedPosterior(object):
+  'A PMF with a queue of pending observations and a published read-only copy.'
+  def __init__(self, pmf):
+    self.pending = []
+    self.pending_lock = threading.Lock()
+    self.update_lock = threading.Lock()
+    self.publish(pmf.copy())
+
+  def publish(self, pmf):
+    '''
+    Publish pmf for readers; it must not be changed afterward. The reference
+    swap is atomic, so readers see either the old or the new posterior, never
+    a mix.
+    '''
+    self.published = (pmf, None)
+
+  def snapshot(self):
+    'Return the published posterior.'
+    return self.published[0]
+
+  def cdf(self):
+    'Return a CDF of the published posterior, built at most once per publication.'
+    published = self.published
+    pmf, cdf = published
+    if cdf is None:
+      cdf = CDF(pmf)
+      # Only cache if nothing newer was published meanwhile.
+      if self.published is published: self.published = (pmf, cdf)
+    return cdf
+
+  def updated(self, pmf, batch):
+    '''
+    Return a copy of pmf updated with every observation of a batch of
+    submissions. Raises UpdateError, or whatever update() raised, if an
+    update failed or left an improper distribution.
+    '''
+    pmf = pmf.copy()
+    for submission in batch:
+      for data in submission.observations:
+        pmf.update(data)
+    total = pmf.total()
+    # Also false for nan.
+    if not 0 < total < float('inf'):
+      raise UpdateError('observations are impossible under every hypothesis')
+    return pmf
+
+  def apply(self, batch):
+    '''
+    Apply a batch of submissions to a copy of the published posterior, and
+    publish the copy. If the batch fails as a whole, apply its submissions one
+    at a time to the last good copy instead, so only the submissions that fail
+    record an error and the rest are still published.
+    '''
+    pmf = self.snapshot()
+    try:
+      pmf = self.updated(pmf, batch)
+    except Exception:
+      for submission in batch:
+        try:
+          pmf = self.updated(pmf, [submission])
+        except Exception as e:
+          submission.error = str(e) if isinstance(e, UpdateError) else 'update failed: {!r}'.format(e)
+    if pmf is not self.snapshot(): self.publish(pmf)
+    for submission in batch:
+      submission.done = True
+
+  def submit(self, observations):
+    '''
+    Queue observations, then apply every queued observation in one pass. If
+    another thread is already applying updates, wait for it; it, or we, will
+    pick up our observations. Returns number of observations applied; raises
+    UpdateError if they could not be applied.
+    '''
+    submission = Submission(observations)
+    with self.pending_lock:
+      self.pending.append(submission)
+    with self.update_lock:
+      if not submission.done:
+        with self.pending_lock:
+          batch, self.pending = self.pending, []
+        self.apply(batch)
+    if submission.error: raise UpdateError(submission.error)
+    return len(observations)
+
+
+class InferenceServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  'Threaded HTTP server hosting named posteriors.'
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self, address=('127.0.0.1', 0), posteriors=None):
+    BaseHTTPServer.HTTPServer.__init__(self, address, InferenceRequestHandler)
+    self.posteriors = {}
+    for name, pmf in dict(posteriors if posteriors else []).iteritems():
+      self.add_posterior(name, pmf)
+
+  def add_posterior(self, name, pmf):
+    'Host pmf under given name, replacing any posterior already of that name.'
+    self.posteriors[name] = HostedPosterior(pmf)
+
+
+class InferenceRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  'Maps URL paths onto queries and updates of hosted posteriors.'
+  def log_message(self, format, *args):
+    pass
+
+  def send_json(self, obj, status=200):
+    body = json.dumps(obj)
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def send_error_json(self, status, message):
+    self.send_json(dict(error=message), status)
+
+  def route(self):
+    '''
+    Split request path into (posterior, action, query). Posterior is None for
+    the list endpoint.
+    '''
+    url = urlparse.urlparse(self.path)
+    query = urlparse.parse_qs(url.query)
+    parts = [part for part in url.path.split('/') if part]
+    if parts == ['posteriors']:
+      return None, None, query
+    if len(parts) != 3 or parts[0] != 'posteriors':
+      raise NotFound('no such endpoint: {}'.format(url.path))
+    name, action = parts[1:]
+    if name not in self.server.posteriors:
+      raise NotFound('no such posterior: {}'.format(name))
+    return self.server.posteriors[name], action, query
+
+  def do_GET(self):
+    try:
+      posterior, action, query = self.route()
+      if posterior is None:
+        result = dict(posteriors=sorted(self.server.posteriors))
+      elif action == 'expectation':
+        result = dict(expectation=posterior.snapshot().expectation())
+      elif action == 'percentiles':
+        probabilities = [float(p) for p in query.get('p', [0.05, 0.95])]
+        for p in probabilities:
+          # Also false for nan.
+          if not 0 <= p <= 1: raise ValueError('percentile must be a probability, not {}'.format(p))
+        result = dict(percentiles=posterior.cdf().percentiles(*probabilities))
+      elif action == 'sample':
+        pmf = posterior.snapshot()
+        if not pmf: raise ValueError("Can't sample an empty posterior")
+        result = dict(sample=[pmf.random() for n in xrange(int(query.get('n', [1])[0]))])
+      else:
+        raise NotFound('no such query: {}'.format(action))
+    except NotFound as e:
+      return self.send_error_json(404, str(e))
+    except (TypeError, ValueError) as e:
+      return self.send_error_json(400, str(e))
+    self.send_json(result)
+
+  def do_POST(self):
+    try:
+      posterior, action, query = self.route()
+      if posterior is None or action != 'update':
+        raise NotFound('no such update: {}'.format(self.path))
+      length = int(self.headers.getheader('Content-Length', 0))
+      observations = json.loads(self.rfile.read(length))['observations']
+      if not isinstance(observations, list):
+        raise TypeError('observations must be a list')
+    except NotFound as e:
+      return self.send_error_json(404, str(e))
+    except KeyError as e:
+      return self.send_error_json(400, 'missing field: {}'.format(e))
+    except (TypeError, ValueError) as e:
+      return self.send_error_json(400, str(e))
+    try:
+      result = dict(updates=posterior.submit(observations))
+    except UpdateError as e:
+      return self.send_error_json(400, str(e))
+    self.send_json(result)
+
+
+def load_factory(spec):
+  'Resolve "module:callable" to the named callable.'
+  module_name, _, attribute = spec.partition(':')
+  module = __import__(module_name, fromlist=[attribute])
+  return getattr(module, attribute)
+
+def main(argv=None):
+  import argparse
+  parser = argparse.ArgumentParser(description='Serve named posteriors over local HTTP/JSON.')
+  parser.add_argument('--host', default='127.0.0.1')
+  parser.add_argument('--port', type=int, default=8000)
+  parser.add_argument('posteriors', nargs='+', metavar='NAME=MODULE:FACTORY',
+    help='factory returning the prior PMF to host under NAME')
+  args = parser.parse_args(argv)
+  server = InferenceServer((args.host, args.port))
+  for spec in args.posteriors:
+    name, _, factory = spec.partition('=')
+    server.add_posterior(name, load_factory(factory)())
+  print "Serving", ", ".join(sorted(server.posteriors)), "on http://{}:{}/".format(*server.server_address)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+
+
+if __name__ == "__main__": main()
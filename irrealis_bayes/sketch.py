@@ -0,0 +1,137 @@
+'''
+Bounded-memory approximate CDF for streams too large to store.
+
+QuantileSketch is a KLL sketch (Karnin, Lang and Liberty, "Optimal Quantile
+Approximation in Streams", 2016). It keeps a stack of compactors: level h holds
+items standing for 2**h stream values each. When a level fills, it is sorted
+and every other item, from a random offset, is promoted to the next level.
+Capacities shrink geometrically toward the lower levels, so total memory stays
+near 3*k items however long the stream.
+
+Error bounds: a percentile query returns a value whose true rank in the stream
+is within epsilon*n of the requested rank, where n is the number of values
+added and epsilon is O(1/k) with high probability. With the default k=200,
+rank errors are typically well under 1%. Sketches built separately, for
+example on different workers, can be merged with no loss beyond that bound, as
+long as they share k.
+'''
+import math, random
+
+
+class QuantileSketch(object):
+  'Mergeable approximate CDF with the percentile API of CDF.'
+  # Ratio of capacities of adjacent levels.
+  shrink = 2./3.
+
+  def __init__(self, k=200, seed=None):
+    self.k = k
+    self.count = 0
+    self.compactors = [[]]
+    self.rng = random.Random(seed)
+    # Items held, and total capacity, kept up to date rather than recomputed
+    # on every add().
+    self._size = 0
+    self._max_size = None
+
+  def __len__(self):
+    'Number of values added, including via merges.'
+    return self.count
+
+  def capacity(self, level):
+    'Number of items level can hold before compacting.'
+    height = len(self.compactors) - level - 1
+    return int(math.ceil(self.k*self.shrink**height)) + 1
+
+  def size(self):
+    'Number of items held.'
+    return self._size
+
+  def max_size(self):
+    'Total capacity of all levels; cached until the number of levels changes.'
+    if self._max_size is None:
+      self._max_size = sum(self.capacity(level) for level in xrange(len(self.compactors)))
+    return self._max_size
+
+  def grow(self):
+    'Add a level on top, which changes every capacity.'
+    self.compactors.append([])
+    self._max_size = None
+
+  def add(self, value):
+    'Add a value from the stream.'
+    self.compactors[0].append(value)
+    self.count += 1
+    self._size += 1
+    if self.max_size() <= self._size: self.compress()
+
+  def extend(self, values):
+    'Add each of an iterable of values.'
+    for value in values: self.add(value)
+
+  def compact(self, level):
+    'Promote every other sorted item of level to the next level, keeping any odd one out.'
+    if len(self.compactors) <= level+1: self.grow()
+    items = self.compactors[level]
+    items.sort()
+    held = [items.pop()] if len(items) % 2 else []
+    offset = 1 if self.rng.random() < 0.5 else 0
+    promoted = items[offset::2]
+    self.compactors[level+1].extend(promoted)
+    self.compactors[level] = held
+    self._size -= len(items) - len(promoted)
+
+  def compress(self):
+    'Compact full levels, from the bottom, until the sketch fits.'
+    for level in xrange(len(self.compactors)):
+      if self.capacity(level) <= len(self.compactors[level]):
+        self.compact(level)
+        if self._size < self.max_size(): break
+
+  def merge(self, other):
+    'Merge another sketch, of the same k, into this one. Returns self.'
+    if other.k != self.k: raise ValueError("Can't merge sketches of different k ({} and {})".format(self.k, other.k))
+    while len(self.compactors) < len(other.compactors): self.grow()
+    for level, compactor in enumerate(other.compactors):
+      self.compactors[level].extend(compactor)
+    self.count += other.count
+    self._size += other._size
+    while self.max_size() <= self._size: self.compress()
+    return self
+
+  def weighted_items(self):
+    'Return sorted list of (value, weight) pairs summarizing the stream.'
+    items = [
+      (value, 2**level)
+      for level, compactor in enumerate(self.compactors)
+      for value in compactor
+    ]
+    items.sort()
+    return items
+
+  def percentile(self, probability):
+    'Return approximate value corresponding to percentile (specified as probability).'
+    return self.percentiles(probability)[0]
+
+  def percentiles(self, *probabilities):
+    '''
+    Return list of approximate values corresponding to list of percentiles
+    (specified as probabilities), as with CDF.percentiles().
+    '''
+    items = self.weighted_items()
+    if not items: raise ValueError("Can't compute percentiles of an empty sketch")
+    total = float(sum(weight for value, weight in items))
+    results = []
+    for probability in probabilities:
+      target = probability*total
+      cumulative = 0
+      for value, weight in items:
+        cumulative += weight
+        if target <= cumulative: break
+      results.append(value)
+    return tuple(results)
+
+  def cumulative(self, value):
+    'Return approximate fraction of the stream at or below value.'
+    items = self.weighted_items()
+    total = float(sum(weight for item, weight in items))
+    return sum(weight for item, weight in items if item <= value)/total if total else 0.
@@ -0,0 +1,257 @@
+'''
+Copy-on-write snapshots of a PMF, for reading a posterior in one thread while
+another thread updates it.
+
+PMF.update() mutates the distribution in place, so a concurrent reader can see
+a half-updated, unnormalized distribution. A SnapshotPMF instead builds each
+new distribution in a private buffer and then publishes it as an immutable
+Snapshot by swapping a single reference. Readers never lock; they just take
+the current snapshot and read from it for as long as they like.
+
+Point changes (set()) don't copy the whole distribution: the new snapshot
+records only the changed events, layered over its parent, and the layers are
+flattened once they grow to a fraction of the base distribution's size.
+Readers don't flatten either: lookups walk the layers, iteration merges them
+on the fly, and expectation() is kept as a running sum updated with each
+change, so reading a layered snapshot never copies the distribution.
+'''
+import random, threading
+
+from irrealis_bayes import PMF, log_ratio
+
+
+class Snapshot(object):
+  '''
+  Immutable, normalized view of a distribution.
+
+  Holds unnormalized weights for changed events, a parent snapshot holding the
+  rest (or None), and the total weight; probabilities are weight/total. Also
+  holds moment, the unnormalized sum of event*weight, or None if unknown or
+  events aren't numeric; without a parent, it is computed from weights.
+  '''
+  def __init__(self, weights, total=None, parent=None, moment=None):
+    self._weights = weights
+    self._parent = parent
+    self._total = float(sum(weights.itervalues()) if total is None else total)
+    if parent is None and moment is None:
+      try:
+        moment = sum(event*weight for event, weight in weights.iteritems())
+      except TypeError:
+        pass
+    self._moment = moment
+    # Compare with None: a snapshot's truth value comes from len(), which walks
+    # its layers, and an empty parent is still a parent.
+    self._flat = None if parent is not None else weights
+    if parent is not None:
+      self.depth = parent.depth + 1
+      self.base_size = parent.base_size
+      self.layer_size = parent.layer_size + len(weights)
+    else:
+      self.depth = self.layer_size = 0
+      self.base_size = len(weights)
+
+  def base(self):
+    'Return the unlayered snapshot at the bottom of this one.'
+    snapshot = self
+    while snapshot._parent is not None: snapshot = snapshot._parent
+    return snapshot
+
+  def changes(self):
+    'Return dict of weights changed relative to base(), newest winning.'
+    layers = []
+    snapshot = self
+    while snapshot._parent is not None:
+      layers.append(snapshot._weights)
+      snapshot = snapshot._parent
+    changes = {}
+    for layer in reversed(layers): changes.update(layer)
+    return changes
+
+  def layers(self):
+    '''
+    Return list of weights of layers, newest first, above the nearest flat
+    snapshot, and that snapshot's dict of weights.
+    '''
+    layers = []
+    snapshot = self
+    while snapshot._flat is None:
+      layers.append(snapshot._weights)
+      snapshot = snapshot._parent
+    return layers, snapshot._flat
+
+  def iterweights(self):
+    'Iterate over (event, unnormalized weight) pairs without flattening.'
+    layers, flat = self.layers()
+    seen = set()
+    for layer in layers:
+      for event, weight in layer.iteritems():
+        if event not in seen:
+          seen.add(event)
+          yield event, weight
+    for event, weight in flat.iteritems():
+      if event not in seen: yield event, weight
+
+  def weights(self):
+    '''
+    Return dict of unnormalized weights of all events; do not modify it. This
+    flattens a layered snapshot, copying the whole distribution once.
+    '''
+    flat = self._flat
+    if flat is None:
+      flat = dict(self._parent.weights())
+      flat.update(self._weights)
+      self._flat = flat
+    return flat
+
+  def weight(self, event):
+    'Return unnormalized weight of event.'
+    snapshot = self
+    while snapshot is not None:
+      if event in snapshot._weights: return snapshot._weights[event]
+      snapshot = snapshot._parent
+    raise KeyError(event)
+
+  def total(self):
+    'Return total unnormalized weight.'
+    return self._total
+
+  def __getitem__(self, event):
+    return self.weight(event)/self._total
+
+  def get(self, event, default=None):
+    try:
+      return self[event]
+    except KeyError:
+      return default
+
+  def __contains__(self, event):
+    try:
+      self.weight(event)
+    except KeyError:
+      return False
+    return True
+
+  def __len__(self):
+    layers, flat = self.layers()
+    changed = set()
+    for layer in layers: changed.update(layer)
+    return len(flat) + sum(1 for event in changed if event not in flat)
+
+  def __iter__(self):
+    return (event for event, weight in self.iterweights())
+
+  def keys(self):
+    return list(self)
+
+  def iteritems(self):
+    total = self._total
+    for event, weight in self.iterweights():
+      yield event, weight/total
+
+  def items(self):
+    return list(self.iteritems())
+
+  def to_pmf(self, cls=PMF):
+    'Return a normalized, mutable PMF copy of this snapshot.'
+    return cls(self.iteritems())
+
+  def expectation(self):
+    'Compute the expectation, aka mean, of this distribution.'
+    if self._moment is not None: return self._moment/self._total
+    try:
+      return sum(event*weight for event, weight in self.iterweights())/self._total
+    except TypeError as e:
+      raise TypeError("Can't compute expectation of non-numeric events ({})".format(e))
+
+  def random(self):
+    '''
+    Returns random event.
+    Since the snapshot never changes, its total is fixed, so this always
+    returns an event.
+    '''
+    target = random.random()*self._total
+    total = 0
+    for event, weight in self.iterweights():
+      total += weight
+      if total >= target:
+        return event
+    # Only reachable through rounding error in the running total.
+    return event
+
+
+class SnapshotPMF(object):
+  '''
+  Wraps a PMF (usually a subclass implementing likelihood()), publishing each
+  change as a new Snapshot. Writers serialize on a lock; readers don't lock.
+  '''
+  # Flatten layered snapshots once changed events exceed this fraction of the
+  # distribution.
+  compaction_ratio = 0.25
+  # Merge layers once a snapshot is this many layers above its base.
+  max_depth = 8
+
+  def __init__(self, pmf):
+    self.pmf = pmf
+    self.log_evidence = pmf.log_evidence
+    self._lock = threading.Lock()
+    self._snapshot = Snapshot(dict(pmf))
+
+  def snapshot(self):
+    'Return the current snapshot.'
+    return self._snapshot
+
+  def publish(self, snapshot):
+    self._snapshot = snapshot
+
+  def likelihood(self, data, given):
+    return self.pmf.likelihood(data, given)
+
+  def update(self, data):
+    'Updates posterior probability distribution given new data.'
+    with self._lock:
+      weights = self._snapshot.weights()
+      events = weights.keys()
+      buffer = dict(
+        (event, weights[event]*likelihood)
+        for event, likelihood in zip(events, self.pmf.likelihoods(data, events))
+      )
+      total = sum(buffer.itervalues())
+      self.log_evidence += log_ratio(total, self._snapshot.total())
+      normalizer = 1./total if total else float('inf')
+      for event in buffer:
+        buffer[event] *= normalizer
+      self.publish(Snapshot(buffer))
+
+  def set(self, event, weight):
+    '''
+    Set unnormalized weight of a single event, relative to the current
+    snapshot's total. Cost is proportional to changed events, amortized over
+    compactions.
+    '''
+    self.set_many({event: weight})
+
+  def set_many(self, weights):
+    'Set unnormalized weights of several events at once.'
+    with self._lock:
+      current = self._snapshot
+      total, moment = current.total(), current._moment
+      for event, weight in weights.iteritems():
+        try:
+          change = weight - current.weight(event)
+        except KeyError:
+          change = weight
+        total += change
+        if moment is not None:
+          try:
+            moment += event*change
+          except TypeError:
+            moment = None
+      snapshot = Snapshot(dict(weights), total, current, moment)
+      if self.compaction_ratio*snapshot.base_size < snapshot.layer_size:
+        # Changes are a sizable fraction of the distribution; flatten, which
+        # also resums the total to shed accumulated rounding error.
+        snapshot = Snapshot(snapshot.weights())
+      elif self.max_depth < snapshot.depth:
+        # Keep point lookups short by merging layers over the base.
+        snapshot = Snapshot(snapshot.changes(), total, snapshot.base(), moment)
+      self.publish(snapshot)
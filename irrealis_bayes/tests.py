@@ -1,7 +1,26 @@
 # -*- coding: utf-8 -*-
-from irrealis_bayes import CDF, PMF, add_two_independent_pmfs, filter_possible_events, sum_independent_pmfs
+from irrealis_bayes import AdaptiveGridPMF, CDF, DynamicCDF, PMF, add_two_independent_pmfs, bayes_factor, convolve, fft, filter_possible_events, log_evidences, sum_independent_pmfs
+from irrealis_bayes.batch import BatchedPosterior
+from irrealis_bayes.calibration import calibrate
+from irrealis_bayes.conjugate import BetaBinomial, DirichletMultinomial, GammaPoisson
+from irrealis_bayes.server import InferenceServer
+from irrealis_bayes.sketch import QuantileSketch
+from irrealis_bayes.snapshot import Snapshot, SnapshotPMF
 
-import random, unittest
+import json, math, random, threading, unittest, urllib2
+
+
+# Calibration runs trials in worker processes, which need to unpickle the
+# model and samplers, so these are defined at module level.
+class CalibrationLocomotiveProblem(PMF):
+  def likelihood(self, data, given):
+    return 0 if given < data else 1./given
+
+def sample_locomotive_count():
+  return random.randint(1, 200)
+
+def sample_locomotive_number(count):
+  return random.randint(1, count)
 
 
 class UnitTestPMF(unittest.TestCase):
@@ -77,6 +96,48 @@ class UnitTestPMF(unittest.TestCase):
     self.assertTrue(0.272 < self.pmf[2] < 0.273)
     self.assertTrue(0.181 < self.pmf[3] < 0.182)
 
+  def test_from_samples(self):
+    samples = [random.gauss(50, 10) for n in xrange(10000)]
+    pmf = PMF.from_samples(samples, xrange(101))
+    self.assertEqual(101, len(pmf))
+    self.assertTrue(0.999 < pmf.total() < 1.001)
+    self.assertTrue(49.5 < pmf.expectation() < 50.5)
+
+  def test_from_samples_ignores_samples_beyond_grid(self):
+    pmf = PMF.from_samples([-10, 0.2, 0.4, 0.6, 1.1, 1.3, 10], [0, 0.5, 1.0])
+    self.assertEqual(0.25, pmf[0])
+    self.assertEqual(0.5, pmf[0.5])
+    self.assertEqual(0.25, pmf[1.0])
+
+  def test_from_samples_needs_samples_on_grid(self):
+    with self.assertRaises(ValueError): PMF.from_samples([], xrange(101))
+    with self.assertRaises(ValueError): PMF.from_samples([-5, 200], xrange(101), bandwidth=3)
+    with self.assertRaises(ValueError): PMF.from_samples([1, 2], [])
+
+  def test_from_samples_checks_arguments(self):
+    with self.assertRaises(ValueError): PMF.from_samples([3], [0, 1, 2, 5, 10])
+    with self.assertRaises(ValueError): PMF.from_samples([3], [2, 1, 0])
+    with self.assertRaises(ValueError): PMF.from_samples([3], xrange(10), bandwidth=-1)
+    with self.assertRaises(ValueError): PMF.from_samples([3], xrange(10), bandwidth=0)
+    # Float grids are even up to rounding error.
+    self.assertEqual(1., PMF.from_samples([0.3], [0.1*n for n in xrange(10)])[0.1*3])
+
+  def test_from_samples_smoothed(self):
+    samples = [random.gauss(50, 10) for n in xrange(2000)]
+    histogram = PMF.from_samples(samples, xrange(101))
+    smoothed = PMF.from_samples(samples, xrange(101), bandwidth=3)
+    self.assertTrue(0.999 < smoothed.total() < 1.001)
+    self.assertTrue(49 < smoothed.expectation() < 51)
+    # Smoothing reduces bin-to-bin jaggedness.
+    def roughness(pmf): return sum(abs(pmf[x+1] - pmf[x]) for x in xrange(100))
+    self.assertTrue(roughness(smoothed) < roughness(histogram)/2)
+    # Smoothed mass near the peak matches the normal density.
+    self.assertTrue(0.035 < smoothed[50] < 0.043)
+    # Smoothing adds the kernel's variance: sqrt(10**2 + 3**2)*1.645 ~= 17.
+    low, high = CDF(smoothed).percentiles(0.05, 0.95)
+    self.assertTrue(31 < low < 35)
+    self.assertTrue(65 < high < 69)
+
   def test_expectation_raises_on_nonnumeric_event(self):
     with self.assertRaises(TypeError): self.pmf.expectation()
 
@@ -107,6 +168,94 @@ class UnitTestPMF(unittest.TestCase):
       self.assertTrue(0.199 < pmf2[key] < 0.201)
 
 
+class TestAdaptiveGridPMF(unittest.TestCase):
+  def setUp(self):
+    class EuroProblem(AdaptiveGridPMF):
+      def likelihood(self, data, given):
+        return given/100. if data == "H" else 1-given/100.
+    self.pmf = EuroProblem()
+    self.pmf.grid_dist(0, 100, 10)
+
+  def test_grid_dist(self):
+    self.assertEqual(10, len(self.pmf))
+    self.assertTrue(0.0999 < self.pmf[5.] < 0.1001)
+    self.assertEqual(10., self.pmf.widths[95.])
+
+  def test_split_preserves_uniform_prior(self):
+    self.assertEqual(10, self.pmf.refine(significant=0.05))
+    self.assertEqual(20, len(self.pmf))
+    self.assertTrue(0.0499 < self.pmf[2.5] < 0.0501)
+    self.assertEqual(5., self.pmf.widths[97.5])
+
+  def test_refine_euro_problem(self):
+    for observation in 'H'*140 + 'T'*110: self.pmf.update(observation)
+    while self.pmf.refine(significant=0.001, min_width=0.5): pass
+    # Fine resolution near the mode, with about a third as many hypotheses as
+    # the fixed 101-point grid.
+    self.assertTrue(len(self.pmf) < 40)
+    self.assertEqual(0.625, min(self.pmf.widths.itervalues()))
+    self.assertTrue(55.9 < self.pmf.expectation() < 56.0)
+    low, high = CDF(self.pmf).percentiles(0.05, 0.95)
+    self.assertTrue(50 < low < 52)
+    self.assertTrue(60 < high < 62)
+
+  def test_refine_uses_likelihoods_hook(self):
+    class EuroProblem(AdaptiveGridPMF):
+      def likelihoods(self, data, events):
+        return [event/100. if data == "H" else 1-event/100. for event in events]
+    pmf = EuroProblem()
+    pmf.grid_dist(0, 100, 10)
+    for observation in 'H'*140 + 'T'*110:
+      pmf.update(observation)
+      self.pmf.update(observation)
+    while pmf.refine(significant=0.001, min_width=0.5): self.pmf.refine(significant=0.001, min_width=0.5)
+    self.assertEqual(sorted(self.pmf), sorted(pmf))
+    self.assertTrue(abs(self.pmf.expectation() - pmf.expectation()) < 1e-9)
+
+  def test_refine_drops_negligible_cells(self):
+    for observation in 'H'*140 + 'T'*110: self.pmf.update(observation)
+    self.pmf.refine(significant=1.)
+    self.assertFalse(5. in self.pmf)
+    self.assertFalse(5. in self.pmf.widths)
+
+  def test_refine_needs_cells(self):
+    self.pmf.uniform_dist(xrange(101))
+    with self.assertRaises(ValueError): self.pmf.refine()
+
+  def test_failed_update_is_not_recorded(self):
+    class EuroProblem(AdaptiveGridPMF):
+      def likelihood(self, data, given):
+        if data not in ('H', 'T'): raise ValueError('not a spin: {!r}'.format(data))
+        return given/100. if data == "H" else 1-given/100.
+    pmf = EuroProblem()
+    pmf.grid_dist(0, 100, 10)
+    with self.assertRaises(ValueError): pmf.update(None)
+    self.assertEqual([], pmf.observations)
+    pmf.update('H')
+    # Refining replays only the good datum.
+    self.assertEqual(10, pmf.refine(significant=0.))
+
+  def test_copy(self):
+    self.pmf.update('H')
+    pmf = self.pmf.copy()
+    pmf.update('H')
+    self.assertEqual(['H'], self.pmf.observations)
+    self.assertEqual(self.pmf.widths, pmf.widths)
+
+
+class TestFFT(unittest.TestCase):
+  def test_convolve(self):
+    result = convolve([1, 2, 3], [0, 1, 0.5])
+    for actual, expected in zip(result, [0, 1, 2.5, 4, 1.5]):
+      self.assertTrue(abs(actual - expected) < 1e-9)
+    self.assertEqual(5, len(result))
+
+  def test_inverse(self):
+    values = [1, 2, 3, 4, 0, 0, 0, 7]
+    for actual, expected in zip(fft(fft(values), inverse=True), values):
+      self.assertTrue(abs(actual - expected) < 1e-9)
+
+
 class TestFilterPossibleEvents(unittest.TestCase):
   def test_filter_possible_events(self):
     pmf = PMF()
@@ -153,6 +302,56 @@ class TestAddPmfs(unittest.TestCase):
     self.assertTrue(0.499 < sum_pmf[1] < 0.501)
     self.assertTrue(0.249 < sum_pmf[2] < 0.251)
 
+  def test_float_sums_grow_support(self):
+    # Without quantization, sums that should be equal differ by rounding
+    # error, and become separate events.
+    pmf = PMF.fromkeys((0.1, 0.2, 0.3), 1.)
+    pmf.normalize()
+    sum_pmf = sum_independent_pmfs([pmf]*6)
+    self.assertTrue(13 < len(sum_pmf))
+
+  def test_quantized_sums(self):
+    pmf = PMF.fromkeys((0.1, 0.2, 0.3), 1.)
+    pmf.normalize()
+    pmf.quantize(resolution=1e-6)
+    sum_pmf = sum_independent_pmfs([pmf]*6)
+    # Sums of six events from {0.1, 0.2, 0.3} are 0.6 through 1.8.
+    self.assertEqual(13, len(sum_pmf))
+    self.assertTrue(0.999 < sum_pmf.total() < 1.001)
+    self.assertTrue(0.001 < sum_pmf[sum_pmf.snap(0.6)] < 0.002)
+    self.assertTrue(1.199 < sum_pmf.expectation() < 1.201)
+
+  def test_add_dicts(self):
+    sum_pmf = add_two_independent_pmfs({1: .5, 2: .5}, {0: 1.})
+    self.assertEqual({1: .5, 2: .5}, sum_pmf)
+
+  def test_add_pmf_and_dict(self):
+    sum_pmf = PMF({1: .5, 2: .5}) + {0: .5, 1: .5}
+    self.assertEqual({1: .25, 2: .5, 3: .25}, sum_pmf)
+
+  def test_add_quantized_to_same_lattice(self):
+    left_pmf, right_pmf = PMF({0.1: 1.}), PMF({0.2: 1.})
+    left_pmf.quantize(resolution=0.1)
+    right_pmf.quantize(resolution=0.1)
+    self.assertEqual([left_pmf.snap(0.3)], (left_pmf + right_pmf).keys())
+    self.assertEqual([left_pmf.snap(0.3)], add_two_independent_pmfs(left_pmf, {0.2: 1.}).keys())
+
+  def test_add_quantized_to_different_lattices_raises(self):
+    left_pmf, right_pmf = PMF({0.1: 1.}), PMF({0.2: 1.})
+    left_pmf.quantize(resolution=0.1)
+    right_pmf.quantize(resolution=0.01)
+    with self.assertRaises(ValueError): left_pmf + right_pmf
+
+  def test_quantize_merges_events(self):
+    pmf = PMF({0.1: 0.25, 0.30000000000000004: 0.25, 0.3: 0.5})
+    pmf.quantize(grid=(0.1, 0.2))
+    self.assertEqual(2, len(pmf))
+    self.assertTrue(0.749 < pmf[pmf.snap(0.3)] < 0.751)
+    self.assertEqual(pmf.snap(0.3), pmf.copy().snap(0.3000001))
+    pmf.uniform_dist([1.0, 1.05, 1.5])
+    self.assertEqual(2, len(pmf))
+    with self.assertRaises(TypeError): pmf.quantize()
+
   def test_sum_three_pmfs(self):
     pmfs = [PMF.fromkeys((0,1), 0.5) for n in range(3)]
     sum_pmf = sum_independent_pmfs(pmfs)
@@ -162,6 +361,64 @@ class TestAddPmfs(unittest.TestCase):
     self.assertTrue(0.124 < sum_pmf[3] < 0.126)
 
 
+class TestLazyPMFs(unittest.TestCase):
+  def setUp(self):
+    self.pmfs = [PMF.fromkeys((0,1), 0.5) for n in range(3)]
+
+  def test_moments_without_convolution(self):
+    total = sum_independent_pmfs([pmf.lazy() for pmf in self.pmfs])
+    self.assertEqual(1.5, total.expectation())
+    self.assertEqual(0.75, total.variance())
+    self.assertEqual(None, total._value)
+
+  def test_evaluate(self):
+    total = self.pmfs[0].lazy() + self.pmfs[1] + self.pmfs[2]
+    self.assertEqual(3, len(total.terms()))
+    self.assertTrue(0.124 < total[0] < 0.126)
+    self.assertTrue(0.374 < total.get(1) < 0.376)
+    self.assertEqual((1, 2), total.percentiles(0.3, 0.8))
+    self.assertTrue(total.random() in (0, 1, 2, 3))
+    self.assertEqual(total.evaluate(), sum_independent_pmfs(self.pmfs))
+
+  def test_mixed_operands(self):
+    total = self.pmfs[0] + self.pmfs[1].lazy() + 10
+    self.assertEqual(11, total.expectation())
+    self.assertEqual(0.5, total.variance())
+    self.assertEqual(set([10, 11, 12]), set(total.evaluate()))
+
+  def test_dict_operands(self):
+    total = self.pmfs[0].lazy() + {0: .5, 1: .5}
+    self.assertEqual(1., total.expectation())
+    self.assertEqual(total.evaluate(), {0: .25, 1: .5, 2: .25})
+    total = {0: 1., 1: 1.} + self.pmfs[0].lazy()
+    self.assertEqual(1., total.expectation())
+
+  def test_unnormalized_operands(self):
+    total = PMF({1:2., 2:2.}).lazy() + PMF({0:1., 1:1.}).lazy()
+    self.assertEqual(2., total.expectation())
+    self.assertEqual(0.5, total.variance())
+    self.assertEqual(total.expectation(), total.evaluate().expectation())
+    self.assertEqual(total.variance(), total.evaluate().variance())
+
+  def test_wrapping_leaves_operand_alone(self):
+    pmf = PMF({1:2., 2:2.})
+    self.assertEqual(1.5, pmf.lazy().expectation())
+    self.assertEqual({1:2., 2:2.}, pmf)
+
+  def test_smallest_first(self):
+    big = PMF()
+    big.uniform_dist(xrange(1000))
+    total = big.lazy() + self.pmfs[0] + self.pmfs[1]
+    self.assertEqual(1002, len(total.evaluate()))
+    self.assertTrue(500.49 < total.expectation() < 500.51)
+    self.assertTrue(abs(total.evaluate().variance() - total.variance()) < 1e-6)
+
+  def test_variance(self):
+    pmf = PMF()
+    pmf.uniform_dist([1, 2, 3])
+    self.assertTrue(0.666 < pmf.variance() < 0.667)
+
+
 class TestCDF(unittest.TestCase):
   def setUp(self):
     self.pmf = PMF()
@@ -183,7 +440,542 @@ class TestCDF(unittest.TestCase):
 
   def test_percentiles(self):
     self.assertEqual(('b', 'd'), self.cdf.percentiles(0.3, 0.8))
-  
+
+
+class TestDynamicCDF(unittest.TestCase):
+  def setUp(self):
+    random.seed(0)
+    self.pmf = PMF()
+    self.pmf.uniform_dist('abcde')
+    self.cdf = DynamicCDF(self.pmf)
+
+  def test_percentile_matches_cdf(self):
+    cdf = CDF(self.pmf)
+    for probability in (0.0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0):
+      self.assertEqual(cdf.percentile(probability), self.cdf.percentile(probability))
+    self.assertEqual(('b', 'd'), self.cdf.percentiles(0.3, 0.8))
+
+  def test_set_and_add(self):
+    self.cdf.set('a', 0.)
+    self.cdf.add('e', 0.2)
+    self.assertTrue(0.999 < self.cdf.total() < 1.001)
+    self.assertEqual(0., self.cdf.prob('a'))
+    self.assertTrue(0.399 < self.cdf.prob('e') < 0.401)
+    self.assertTrue(0.599 < self.cdf.cumulative('d') < 0.601)
+    self.pmf['a'], self.pmf['e'] = 0., 0.4
+    cdf = CDF(self.pmf)
+    for probability in (0.0, 0.1, 0.25, 0.3, 0.5, 0.61, 0.9, 1.0):
+      self.assertEqual(cdf.percentile(probability), self.cdf.percentile(probability))
+
+  def test_add_new_event(self):
+    self.cdf.add('f', 1.)
+    self.assertEqual('f', self.cdf.percentile(0.9))
+    self.assertTrue(0.499 < self.cdf.prob('f') < 0.501)
+
+  def test_random_skips_impossible_events(self):
+    self.cdf.set('c', 0.)
+    simulation_pmf = PMF()
+    for n in range(10000):
+      x = self.cdf.random()
+      simulation_pmf[x] = simulation_pmf.get(x, 0) + 1
+    simulation_pmf.normalize()
+    self.assertFalse('c' in simulation_pmf)
+    for x in 'abde':
+      self.assertTrue(0.240 < simulation_pmf[x] < 0.260)
+
+  def test_online_counts_match_rebuilt_cdf(self):
+    # Count-based model: observe rolls one at a time, querying percentiles in
+    # between, without rebuilding a CDF after each roll.
+    counts = PMF.fromkeys(xrange(1, 21), 0.)
+    cdf = DynamicCDF(counts)
+    for n in range(500):
+      roll = random.randint(1, 20)
+      counts[roll] += 1
+      cdf.add(roll, 1)
+      if n % 50 == 49:
+        pmf = counts.copy()
+        pmf.normalize()
+        self.assertEqual(CDF(pmf).percentiles(0.05, 0.5, 0.95), cdf.percentiles(0.05, 0.5, 0.95))
+    self.assertEqual(500, cdf.total())
+
+
+class TestQuantileSketch(unittest.TestCase):
+  def setUp(self):
+    random.seed(0)
+    self.values = range(100000)
+    random.shuffle(self.values)
+
+  def assertRankError(self, sketch, tolerance=0.01):
+    probabilities = (0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99)
+    for probability, value in zip(probabilities, sketch.percentiles(*probabilities)):
+      self.assertTrue(abs(value/100000. - probability) < tolerance)
+
+  def test_percentiles(self):
+    sketch = QuantileSketch(seed=0)
+    sketch.extend(self.values)
+    self.assertEqual(100000, len(sketch))
+    self.assertRankError(sketch)
+    self.assertTrue(0.49 < sketch.cumulative(50000) < 0.51)
+
+  def test_bounded_memory(self):
+    sketch = QuantileSketch(k=100, seed=0)
+    sketch.extend(self.values[:1000])
+    size = sketch.size()
+    sketch.extend(self.values[1000:])
+    self.assertTrue(sketch.size() < 4*100)
+    self.assertTrue(sketch.size() < 2*size)
+
+  def test_merge(self):
+    sketches = [QuantileSketch(seed=n) for n in range(4)]
+    for n, value in enumerate(self.values): sketches[n % 4].add(value)
+    merged = reduce(QuantileSketch.merge, sketches)
+    self.assertEqual(100000, len(merged))
+    self.assertTrue(merged.size() < 4*200)
+    self.assertRankError(merged)
+
+  def test_size_is_tracked(self):
+    sketch = QuantileSketch(k=50, seed=0)
+    sketch.extend(self.values[:5000])
+    other = QuantileSketch(k=50, seed=1)
+    other.extend(self.values[5000:7000])
+    sketch.merge(other)
+    self.assertEqual(sum(len(compactor) for compactor in sketch.compactors), sketch.size())
+    self.assertEqual(sum(sketch.capacity(level) for level in xrange(len(sketch.compactors))), sketch.max_size())
+
+  def test_merge_requires_same_k(self):
+    with self.assertRaises(ValueError): QuantileSketch(k=100).merge(QuantileSketch(k=200))
+
+  def test_small_stream_is_exact(self):
+    pmf = PMF()
+    pmf.uniform_dist('abcde')
+    sketch = QuantileSketch()
+    sketch.extend('abcde')
+    self.assertEqual(CDF(pmf).percentiles(0.1, 0.3, 0.8, 1.0), sketch.percentiles(0.1, 0.3, 0.8, 1.0))
+
+  def test_empty(self):
+    with self.assertRaises(ValueError): QuantileSketch().percentile(0.5)
+
+
+class TestInferenceServer(unittest.TestCase):
+  def setUp(self):
+    class EuroProblem(PMF):
+      def likelihood(self, data, given):
+        if data not in ('H', 'T'): raise ValueError('not a spin: {!r}'.format(data))
+        return given/100. if data == "H" else 1-given/100.
+    pmf = EuroProblem()
+    pmf.uniform_dist(xrange(101))
+    self.server = InferenceServer(posteriors=dict(euro=pmf))
+    self.thread = threading.Thread(target=self.server.serve_forever, args=(0.01,))
+    self.thread.daemon = True
+    self.thread.start()
+    self.url = 'http://{}:{}'.format(*self.server.server_address)
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def get(self, path):
+    return json.load(urllib2.urlopen(self.url + path))
+
+  def post(self, path, obj):
+    request = urllib2.Request(self.url + path, json.dumps(obj), {'Content-Type': 'application/json'})
+    return json.load(urllib2.urlopen(request))
+
+  def test_list_posteriors(self):
+    self.assertEqual(['euro'], self.get('/posteriors')['posteriors'])
+
+  def test_update_and_query(self):
+    self.assertTrue(49.99 < self.get('/posteriors/euro/expectation')['expectation'] < 50.01)
+    self.assertEqual(250, self.post('/posteriors/euro/update', dict(observations=list('H'*140 + 'T'*110)))['updates'])
+    self.assertTrue(55.95 < self.get('/posteriors/euro/expectation')['expectation'] < 55.96)
+    self.assertEqual([51, 61], self.get('/posteriors/euro/percentiles?p=0.05&p=0.95')['percentiles'])
+    sample = self.get('/posteriors/euro/sample?n=5')['sample']
+    self.assertEqual(5, len(sample))
+    for x in sample: self.assertTrue(0 <= x <= 100)
+
+  def test_concurrent_updates_are_all_applied(self):
+    threads = [
+      threading.Thread(target=self.post, args=('/posteriors/euro/update', dict(observations=list('H'*14 + 'T'*11))))
+      for n in range(10)
+    ]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    self.assertTrue(55.95 < self.get('/posteriors/euro/expectation')['expectation'] < 55.96)
+
+  def test_unknown_posterior(self):
+    with self.assertRaises(urllib2.HTTPError) as context: self.get('/posteriors/dice/expectation')
+    self.assertEqual(404, context.exception.code)
+
+  def test_unknown_query(self):
+    with self.assertRaises(urllib2.HTTPError) as context: self.get('/posteriors/euro/median')
+    self.assertEqual(404, context.exception.code)
+
+  def test_bad_queries(self):
+    self.server.add_posterior('empty', PMF())
+    for path in ('/posteriors/euro/percentiles?p=1.5', '/posteriors/euro/percentiles?p=-0.1', '/posteriors/empty/sample'):
+      with self.assertRaises(urllib2.HTTPError) as context: self.get(path)
+      self.assertEqual(400, context.exception.code)
+
+  def test_malformed_update(self):
+    with self.assertRaises(urllib2.HTTPError) as context: self.post('/posteriors/euro/update', dict(data=[]))
+    self.assertEqual(400, context.exception.code)
+
+  def test_failed_update_leaves_posterior_unchanged(self):
+    self.post('/posteriors/euro/update', dict(observations=['H']))
+    expectation = self.get('/posteriors/euro/expectation')['expectation']
+    # Non-string data makes likelihood() raise partway through the batch.
+    with self.assertRaises(urllib2.HTTPError) as context:
+      self.post('/posteriors/euro/update', dict(observations=['H', None, 'T']))
+    self.assertEqual(400, context.exception.code)
+    self.assertEqual(expectation, self.get('/posteriors/euro/expectation')['expectation'])
+    # Later updates apply to the unchanged posterior.
+    self.assertEqual(1, self.post('/posteriors/euro/update', dict(observations=['T']))['updates'])
+    self.assertTrue(49.99 < self.get('/posteriors/euro/expectation')['expectation'] < 50.01)
+
+  def test_impossible_update_is_rejected(self):
+    # A coin that never lands heads.
+    EuroProblem = self.server.posteriors['euro'].snapshot().__class__
+    self.server.add_posterior('tails', EuroProblem({0: 1.}))
+    with self.assertRaises(urllib2.HTTPError) as context:
+      self.post('/posteriors/tails/update', dict(observations=['H']))
+    self.assertEqual(400, context.exception.code)
+    self.assertEqual(0., self.get('/posteriors/tails/expectation')['expectation'])
+
+  def test_failed_submission_fails_only_its_submitter(self):
+    posterior = self.server.posteriors['euro']
+    # Hold the update lock so both submissions coalesce into one batch.
+    results = []
+    def submit(observations):
+      try:
+        results.append(posterior.submit(observations))
+      except ValueError as e:
+        results.append(e)
+    posterior.update_lock.acquire()
+    threads = [threading.Thread(target=submit, args=(observations,)) for observations in (['H'], [None], ['H'])]
+    for thread in threads: thread.start()
+    while len(posterior.pending) < 3: pass
+    posterior.update_lock.release()
+    for thread in threads: thread.join()
+    self.assertEqual(3, len(results))
+    self.assertEqual(1, len([result for result in results if isinstance(result, ValueError)]))
+    self.assertEqual([1, 1], [result for result in results if not isinstance(result, ValueError)])
+    # Both valid submissions were applied.
+    pmf = posterior.snapshot()
+    self.assertTrue(75.37 < pmf.expectation() < 75.38)
+
+
+class TestSnapshotPMF(unittest.TestCase):
+  def setUp(self):
+    class EuroProblem(PMF):
+      def likelihood(self, data, given):
+        return given/100. if data == "H" else 1-given/100.
+    pmf = EuroProblem()
+    pmf.uniform_dist(xrange(101))
+    self.suite = SnapshotPMF(pmf)
+
+  def test_update(self):
+    snapshot = self.suite.snapshot()
+    for observation in 'H'*140 + 'T'*110: self.suite.update(observation)
+    # Old snapshot is untouched.
+    self.assertTrue(49.99 < snapshot.expectation() < 50.01)
+    snapshot = self.suite.snapshot()
+    self.assertTrue(55.95 < snapshot.expectation() < 55.96)
+    self.assertEqual((51, 61), CDF(snapshot).percentiles(0.05, 0.95))
+    self.assertTrue(55.95 < snapshot.to_pmf().expectation() < 55.96)
+
+  def test_set_is_normalized_and_layered(self):
+    self.suite.set(100, 0.)
+    snapshot = self.suite.snapshot()
+    self.assertEqual(0., snapshot[100])
+    self.assertTrue(0.00999 < snapshot[0] < 0.01001)
+    self.assertTrue(0.999 < sum(prob for event, prob in snapshot.iteritems()) < 1.001)
+    # Point change only stored the changed event.
+    self.assertEqual({100: 0.}, snapshot.changes())
+
+  def test_set_does_not_flatten_parent(self):
+    self.suite.set(100, 0.)
+    child = self.suite.snapshot()
+    self.suite.set(99, 0.)
+    # Neither layer copied the distribution below it.
+    self.assertEqual(None, child._flat)
+    self.assertEqual(None, self.suite.snapshot()._flat)
+    self.assertEqual(2, self.suite.snapshot().depth)
+
+  def test_reading_layers_does_not_flatten(self):
+    self.suite.set(100, 0.)
+    self.suite.set(101, 1.)
+    snapshot = self.suite.snapshot()
+    self.assertEqual(102, len(snapshot))
+    self.assertEqual(set(range(102)), set(snapshot))
+    self.assertTrue(0.999 < sum(prob for event, prob in snapshot.iteritems()) < 1.001)
+    self.assertTrue(snapshot.random() in snapshot)
+    self.assertEqual(CDF(snapshot.to_pmf()).percentiles(0.05, 0.95), CDF(snapshot).percentiles(0.05, 0.95))
+    self.assertEqual(None, snapshot._flat)
+    # The running expectation matches one computed from scratch.
+    self.assertTrue(abs(snapshot.expectation() - snapshot.to_pmf().expectation()) < 1e-9)
+
+  def test_non_numeric_events(self):
+    suite = SnapshotPMF(PMF(a=1., b=1.))
+    suite.set('c', 2.)
+    self.assertEqual(0.5, suite.snapshot()['c'])
+    with self.assertRaises(TypeError): suite.snapshot().expectation()
+
+  def test_empty_parent(self):
+    snapshot = Snapshot({'a': 1.}, parent=Snapshot({}))
+    self.assertEqual(1, snapshot.depth)
+    self.assertEqual(0, snapshot.base_size)
+    self.assertEqual(1., snapshot['a'])
+
+  def test_layers_are_compacted(self):
+    for event in range(30): self.suite.set(event, 2.)
+    snapshot = self.suite.snapshot()
+    self.assertTrue(snapshot.depth <= SnapshotPMF.max_depth)
+    self.assertTrue(snapshot.layer_size <= 0.25*snapshot.base_size)
+    self.assertTrue(0.0329 < snapshot[0] < 0.0330)
+    self.assertTrue(0.999 < sum(prob for event, prob in snapshot.iteritems()) < 1.001)
+
+  def test_random_always_returns_event(self):
+    snapshot = self.suite.snapshot()
+    for n in range(1000): self.assertTrue(snapshot.random() in snapshot)
+
+  def test_concurrent_readers_see_normalized_snapshots(self):
+    totals = []
+    def read():
+      for n in range(200):
+        totals.append(sum(prob for event, prob in self.suite.snapshot().iteritems()))
+    reader = threading.Thread(target=read)
+    reader.start()
+    for observation in 'H'*140 + 'T'*110: self.suite.update(observation)
+    reader.join()
+    for total in totals: self.assertTrue(0.999 < total < 1.001)
+
+
+class TestEvidence(unittest.TestCase):
+  '''
+  From Think Bayes, on whether the euro data give evidence that the coin is
+  biased: compare P(data) under the hypothesis that the coin is fair with
+  P(data) under a uniform prior on its bias.
+  '''
+  def setUp(self):
+    class EuroProblem(PMF):
+      def likelihood(self, data, given):
+        return given/100. if data == "H" else 1-given/100.
+    self.fair, self.biased = EuroProblem(), EuroProblem()
+    self.fair.uniform_dist([50])
+    self.biased.uniform_dist(xrange(101))
+    self.observations = 'H'*140 + 'T'*110
+
+  def test_log_evidence(self):
+    for observation in self.observations: self.fair.update(observation)
+    self.assertTrue(abs(self.fair.log_evidence - 250*math.log(0.5)) < 1e-9)
+    # Grid evidence approximates the Beta-Binomial evidence.
+    conjugate = BetaBinomial(success='H')
+    for observation in self.observations:
+      self.biased.update(observation)
+      conjugate.update(observation)
+    self.assertTrue(abs(self.biased.log_evidence - conjugate.log_evidence) < 0.01)
+
+  def test_bayes_factor(self):
+    factor = bayes_factor(self.biased, self.fair, self.observations)
+    # The data slightly favor the fair coin.
+    self.assertTrue(0.47 < factor < 0.48)
+    # Suites were updated as well.
+    self.assertTrue(55.95 < self.biased.expectation() < 55.96)
+
+  def test_log_evidences_of_several_suites(self):
+    conjugate = BetaBinomial(success='H')
+    evidences = log_evidences([self.fair, self.biased, conjugate], self.observations)
+    self.assertEqual(3, len(evidences))
+    self.assertTrue(abs(evidences[1] - evidences[2]) < 0.01)
+
+  def test_prior_resets_evidence(self):
+    self.biased.update('H')
+    self.assertTrue(self.biased.log_evidence < 0)
+    self.assertEqual(self.biased.log_evidence, self.biased.copy().log_evidence)
+    self.biased.uniform_dist(xrange(101))
+    self.assertEqual(0., self.biased.log_evidence)
+
+  def test_impossible_data(self):
+    self.fair.uniform_dist([0])
+    self.fair.update('H')
+    self.assertEqual(float('-inf'), self.fair.log_evidence)
+
+  def test_snapshot_pmf_evidence(self):
+    suite = SnapshotPMF(self.biased.copy())
+    for observation in self.observations:
+      suite.update(observation)
+      self.biased.update(observation)
+    self.assertTrue(abs(suite.log_evidence - self.biased.log_evidence) < 1e-9)
+
+  def test_conjugate_evidence_is_order_independent(self):
+    sequential, batch = GammaPoisson(1, 1), GammaPoisson(1, 1)
+    sequential.update(3)
+    sequential.update(4)
+    batch.observe(7, 2)
+    # Total count evidence differs from sequence evidence by the multinomial
+    # split of 7 events into 3 and 4.
+    split = math.log(math.factorial(7)/(math.factorial(3)*math.factorial(4)) * 0.5**7)
+    self.assertTrue(abs(sequential.log_evidence - (batch.log_evidence + split)) < 1e-9)
+    sequential, batch = DirichletMultinomial(dict(a=1, b=2)), DirichletMultinomial(dict(a=1, b=2))
+    for category in 'abba': sequential.update(category)
+    batch.observe(dict(a=2, b=2))
+    self.assertTrue(abs(sequential.log_evidence - batch.log_evidence) < 1e-9)
+
+
+class TestBatchedPosterior(unittest.TestCase):
+  def setUp(self):
+    class EuroProblem(BatchedPosterior):
+      calls = 0
+      def likelihood(self, data, given):
+        self.calls += 1
+        return given/100. if data == "H" else 1-given/100.
+    class SingleEuroProblem(PMF):
+      def likelihood(self, data, given):
+        return given/100. if data == "H" else 1-given/100.
+    self.batch = EuroProblem(xrange(101), 3)
+    self.single = SingleEuroProblem
+    # Three coins: the euro coin, a fair-looking coin, and one seen once.
+    self.spins = ['H'*140 + 'T'*110, 'HT'*125, 'H']
+
+  def test_matches_single_posteriors(self):
+    for n in xrange(250):
+      self.batch.update([spins[n] if n < len(spins) else None for spins in self.spins])
+    expectations = self.batch.expectation()
+    percentiles = self.batch.percentiles(0.05, 0.95)
+    for index, spins in enumerate(self.spins):
+      pmf = self.single()
+      pmf.uniform_dist(xrange(101))
+      for spin in spins: pmf.update(spin)
+      self.assertTrue(abs(pmf.expectation() - expectations[index]) < 1e-9)
+      self.assertEqual(CDF(pmf).percentiles(0.05, 0.95), percentiles[index])
+      self.assertTrue(abs(pmf.log_evidence - self.batch.log_evidence[index]) < 1e-9)
+    self.assertEqual((51, 61), percentiles[0])
+    self.assertTrue(55.95 < self.batch.pmf(0).expectation() < 55.96)
+
+  def test_update_needs_one_datum_per_posterior(self):
+    with self.assertRaises(ValueError): self.batch.update(['H'])
+    with self.assertRaises(ValueError): self.batch.update(['H']*4)
+    # Neither batch changed any posterior.
+    for expectation in self.batch.expectation(): self.assertTrue(49.99 < expectation < 50.01)
+
+  def test_likelihood_vectors_are_shared(self):
+    self.batch.update(['H', 'H', 'T'])
+    # One vector per distinct datum, not per posterior.
+    self.assertEqual(2*101, self.batch.calls)
+    self.batch.update_each('T')
+    self.assertEqual(3*101, self.batch.calls)
+
+  def test_percentiles_in_any_order(self):
+    self.batch.update_each('H')
+    self.assertEqual([(71, 22)]*3, self.batch.percentiles(0.5, 0.05))
+
+  def test_prior(self):
+    prior = PMF()
+    prior.power_law_dist(xrange(1, 4))
+    batch = BatchedPosterior([3, 1, 2], 2, prior)
+    self.assertEqual([1, 2, 3], batch.events)
+    self.assertTrue(0.545 < batch.rows[1][0] < 0.546)
+
+
+class TestConjugatePosteriors(unittest.TestCase):
+  def setUp(self):
+    random.seed(0)
+
+  def test_beta_binomial_euro_problem(self):
+    posterior = BetaBinomial(success='H')
+    for observation in 'H'*140 + 'T'*110: posterior.update(observation)
+    self.assertTrue(0.5595 < posterior.expectation() < 0.5596)
+    low, high = posterior.percentiles(0.05, 0.95)
+    self.assertTrue(0.507 < low < 0.509)
+    self.assertTrue(0.610 < high < 0.611)
+    # Same answer as the grid PMF in FunctionalTestPMF.test_euro_problem().
+    pmf = posterior.to_pmf(xrange(101), scale=100.)
+    self.assertTrue(55.95 < pmf.expectation() < 55.96)
+    self.assertEqual((51, 61), CDF(pmf).percentiles(0.05, 0.95))
+
+  def test_beta_binomial_observe_counts(self):
+    posterior = BetaBinomial()
+    posterior.observe(140, 110)
+    self.assertTrue(0.5595 < posterior.expectation() < 0.5596)
+    self.assertTrue(0.5596 < posterior.percentile(0.5) < 0.5597)
+
+  def test_beta_binomial_sample(self):
+    posterior = BetaBinomial(141, 111)
+    sample = posterior.sample(10000)
+    self.assertTrue(0.557 < sum(sample)/len(sample) < 0.562)
+    for x in sample: self.assertTrue(0 <= x <= 1)
+
+  def test_beta_density_at_endpoints(self):
+    self.assertEqual(1., BetaBinomial().density(0.))
+    self.assertEqual(0., BetaBinomial(2, 1).density(0.))
+    self.assertEqual(float('inf'), BetaBinomial(1, 0.5).density(1.))
+    self.assertEqual(0., BetaBinomial().density(1.5))
+
+  def test_gamma_poisson(self):
+    posterior = GammaPoisson()
+    for count in (3, 4, 2, 5, 6): posterior.update(count)
+    self.assertTrue(4.199 < posterior.expectation() < 4.201)
+    low, median, high = posterior.percentiles(0.05, 0.5, 0.95)
+    self.assertTrue(2.81 < low < 2.82)
+    self.assertTrue(4.13 < median < 4.14)
+    self.assertTrue(5.81 < high < 5.82)
+    pmf = posterior.to_pmf([n/10. for n in xrange(1, 201)])
+    self.assertTrue(4.19 < pmf.expectation() < 4.21)
+
+  def test_gamma_poisson_improper_prior(self):
+    posterior = GammaPoisson()
+    for query in (posterior.expectation, posterior.random, lambda: posterior.percentile(0.5), lambda: posterior.to_pmf([1, 2])):
+      with self.assertRaises(ValueError): query()
+    posterior.update(0)
+    self.assertEqual(1., posterior.expectation())
+
+  def test_dirichlet_multinomial(self):
+    posterior = DirichletMultinomial(dict(a=1, b=1, c=1))
+    posterior.observe(dict(a=10, b=5))
+    posterior.update('c')
+    expectation = posterior.expectation()
+    self.assertTrue(0.578 < expectation['a'] < 0.579)
+    self.assertTrue(0.105 < expectation['c'] < 0.106)
+    low, high = posterior.percentiles(0.05, 0.95)['a']
+    self.assertEqual((low, high), posterior.marginal('a').percentiles(0.05, 0.95))
+    self.assertTrue(low < expectation['a'] < high)
+    draw = posterior.random()
+    self.assertTrue(0.999 < draw.total() < 1.001)
+    self.assertEqual(set('abc'), set(draw))
+
+
+class TestCalibration(unittest.TestCase):
+  def setUp(self):
+    self.suite = CalibrationLocomotiveProblem()
+    self.suite.uniform_dist(xrange(1, 201))
+
+  def calibrate(self, **kw):
+    return calibrate(self.suite, sample_locomotive_count, sample_locomotive_number, 3, trials=200, **kw)
+
+  def test_calibrated_model(self):
+    # Parameters are drawn from the prior, so the model is calibrated by
+    # construction, and its 90% intervals should cover about 90% of the time.
+    report = self.calibrate(processes=1)
+    self.assertEqual(200, report.trials)
+    # Discrete intervals include both endpoints, so they err on the wide side.
+    self.assertTrue(0.85 < report.coverage < 0.98)
+    self.assertTrue(-5 < report.bias < 5)
+
+  def test_results_dont_depend_on_workers(self):
+    serial = self.calibrate(processes=1)
+    parallel = self.calibrate(processes=3)
+    self.assertEqual(serial.coverage, parallel.coverage)
+    self.assertEqual(serial.bias, parallel.bias)
+    self.assertEqual(serial.rmse, parallel.rmse)
+    self.assertNotEqual(serial.bias, self.calibrate(processes=1, seed=1).bias)
+
+  def test_preserves_random_state(self):
+    random.seed(0)
+    expected = random.random()
+    random.seed(0)
+    self.calibrate(processes=1)
+    self.assertEqual(expected, random.random())
+
 
 class FunctionalTestPMF(unittest.TestCase):
   def test_basic_cookie_problem(self):
@@ -241,6 +1033,45 @@ class FunctionalTestPMF(unittest.TestCase):
     pmf.normalize()
     self.assertTrue(0.599 < pmf['bowl_1'] < 0.601)
 
+  def test_predictive(self):
+    '''
+    test_predictive (irrealis_bayes.tests.FunctionalTestPMF)
+
+    After observing a 6 in the dice problem, the probability that the next
+    roll is a 1 sums, over the dice that could have rolled the 6, the
+    posterior probability of each die times the chance it rolls a 1.
+    '''
+    class DiceProblem(PMF):
+      def likelihood(self, data, given):
+        return 0 if given < data else 1./given
+
+    pmf = DiceProblem()
+    pmf.uniform_dist([4,6,8,12,20])
+    pmf.update(6)
+    predictive = pmf.predictive(xrange(1, 21))
+    self.assertTrue(0.999 < predictive.total() < 1.001)
+    expected = sum(pmf[die]/die for die in (6,8,12,20))
+    self.assertTrue(expected - 0.001 < predictive[1] < expected + 0.001)
+    self.assertEqual(predictive[1], predictive[6])
+    self.assertTrue(predictive[7] < predictive[6])
+    self.assertTrue(0.005 < predictive[20] < 0.006)
+
+  def test_predictive_uses_vectorized_likelihoods(self):
+    class EuroProblem(PMF):
+      calls = 0
+      def likelihoods(self, data, events):
+        self.calls += 1
+        return [event/100. if data == "H" else 1-event/100. for event in events]
+
+    pmf = EuroProblem()
+    pmf.uniform_dist(xrange(101))
+    for observation in 'H'*140 + 'T'*110: pmf.update(observation)
+    self.assertEqual(250, pmf.calls)
+    predictive = pmf.predictive('HT')
+    self.assertEqual(252, pmf.calls)
+    # Probability of heads on the next spin is the posterior mean.
+    self.assertTrue(0.5595 < predictive['H'] < 0.5596)
+
   def test_unimplemented_likelihood_raises(self):
     pmf = PMF(x = 2)
     with self.assertRaises(NotImplementedError): pmf.update('blah')
@@ -687,9 +1518,13 @@ class FunctionalTestPMF(unittest.TestCase):
     summed_credible_interval = [sum(array) for array in endpoint_arrays]
     print "90% summed_credible_interval:", summed_credible_interval
 
-    # Third thingwe can try is distribution of sums.
-    sum_pmf = sum_independent_pmfs(pmfs)
-    print "expectation of sum:", sum_pmf.expectation()
+    # Third thingwe can try is distribution of sums. The expectation of the
+    # sum is the sum of expectations, which a lazy sum computes without
+    # convolving.
+    lazy_sum = sum_independent_pmfs([pmf.lazy() for pmf in pmfs])
+    print "expectation of sum:", lazy_sum.expectation()
+    sum_pmf = lazy_sum.evaluate()
+    self.assertTrue(abs(sum_pmf.expectation() - lazy_sum.expectation()) < 1e-6)
     sum_cdf = CDF(sum_pmf)
     credible_interval_of_sum = sum_cdf.percentiles(0.05, 0.95)
     print "90% credible interval of sum:", credible_interval_of_sum
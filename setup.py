@@ -21,5 +21,7 @@ setup(name='irrealis_bayes',
       ],
       entry_points="""
       # -*- Entry points: -*-
+      [console_scripts]
+      irrealis_bayes_server = irrealis_bayes.server:main
       """,
       )